@@ -0,0 +1,158 @@
+"""
+Batch Runs
+Cynthia Shao and Jonathan Brown
+
+Runs the baseline and the traced + optimized pipeline over every Bril file
+matching a glob, spread across a process pool, and writes a brench style csv
+(benchmark,run,result) like brench/trace_correctness.csv or
+brench/trace_dyn_instr.csv.
+
+  python batch.py 'core/*.bril' --metric dyn_instr -o dyn.csv
+  python batch.py '../dataflow/core/*.bril' --metric correctness -j 8
+"""
+
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import cache
+import pipeline
+import trace
+
+ARGS_RE = r"# ARGS: (.*)"
+DYN_RE = r"total_dyn_inst: (\d+)"
+
+METRICS = ["correctness", "dyn_instr"]
+
+def read_headers(bril):
+    """
+    program args from the ARGS header and trace args from the TRACE_ARG header,
+    files without a TRACE_ARG are traced on their ARGS
+    """
+    match = re.search(ARGS_RE, bril)
+    args = match.group(1).split() if match else []
+    match = re.search(trace.ARGS_RE, bril)
+    trace_args = [match.group(1)] if match else args
+    return args, trace_args
+
+def run_brili(program_json, args, timeout):
+    """run brili -p, returns (output, dyn count) or a brench error string for both"""
+    try:
+        result = subprocess.run(
+            ["brili", "-p", *args],
+            input=program_json,
+            text=True,
+            capture_output=True,
+            timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        return "timeout", "timeout"
+    match = re.search(DYN_RE, result.stderr)
+    if result.returncode != 0 or not match:
+        return "missing", "missing"
+    return " ".join(result.stdout.split()), match.group(1)
+
+def report_failure(name, e):
+    reason = f"exited with status {e.code}" if isinstance(e, SystemExit) else e
+    print(f"{name}: {reason}", file=sys.stderr)
+
+def run_benchmark(job):
+    """
+    Run one file through the baseline and the pipeline. Returns
+    (benchmark, {run: (output, dyn count)}, cache counts or None). Lives at
+    module level so the process pool can pickle it. A benchmark that fails
+    in any way, including a pass calling sys.exit, gets missing rows instead
+    of taking the whole batch down.
+    """
+    path = job[0]
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        return benchmark_results(name, job)
+    except (Exception, SystemExit) as e:
+        report_failure(name, e)
+        missing = ("missing", "missing")
+        return name, {"baseline": missing, "trace_correctness": missing}, None
+
+def benchmark_results(name, job):
+    path, pass_list, trace_options, timeout, cache_dir, memo_dir, cache_bytes = job
+    with open(path) as f:
+        bril = f.read()
+    args, trace_args = read_headers(bril)
+    bril_json = trace.parse_bril(bril)
+    results = {"baseline": run_brili(bril_json, args, timeout)}
+    result_cache = cache.Cache(cache_dir, cache_bytes) if cache_dir else None
+    memo = cache.Cache(memo_dir, cache_bytes) if memo_dir else None
+    try:
+        optimized = pipeline.optimize(bril_json, pass_list, trace_args, trace_options, result_cache, memo)
+        results["trace_correctness"] = run_brili(json.dumps(optimized), args, timeout)
+    except (Exception, SystemExit) as e:
+        report_failure(name, e)
+        results["trace_correctness"] = ("missing", "missing")
+    counts = result_cache.counts() if result_cache else None
+    return name, results, counts
+
+def rows_for(name, results, metric):
+    baseline_output = results["baseline"][0]
+    for run in ("baseline", "trace_correctness"):
+        output, dyn = results[run]
+        if metric == "correctness":
+            result = output
+        else:
+            result = dyn
+        if run != "baseline" and output not in ("missing", "timeout") and output != baseline_output:
+            result = "incorrect"
+        yield [name, run, result]
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the trace pipeline over a directory of Bril programs')
+    parser.add_argument('pattern', help="Glob of Bril files, e.g. 'core/*.bril'")
+    parser.add_argument('-m', '--metric', choices=METRICS, default="dyn_instr",
+                        help='correctness writes program output, dyn_instr writes brili -p counts')
+    parser.add_argument('-p', '--passes', default=",".join(pipeline.DEFAULT_PASSES),
+                        help='Comma separated list of passes to run (default: trace,lvn,guards,dce)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Worker processes (default: all cores)')
+    parser.add_argument('-t', '--timeout', type=float, default=60,
+                        help='Seconds before a brili run counts as a timeout')
+    parser.add_argument('-o', '--output', help='Write the csv here instead of stdout')
+    trace.add_trace_options(parser)
+    pipeline.add_cache_options(parser)
+    parsed_args = parser.parse_args()
+
+    try:
+        pass_list = pipeline.parse_pass_list(parsed_args.passes)
+    except ValueError as e:
+        parser.error(str(e))
+
+    paths = sorted(glob.glob(parsed_args.pattern))
+    if not paths:
+        parser.error(f"no files match {parsed_args.pattern}")
+    trace_options = trace.trace_options(parsed_args)
+    cache_bytes = int(parsed_args.cache_size * 2**20)
+    jobs = [(path, pass_list, trace_options, parsed_args.timeout, parsed_args.cache,
+             parsed_args.incremental, cache_bytes) for path in paths]
+
+    out = open(parsed_args.output, "w", newline="") if parsed_args.output else sys.stdout
+    writer = csv.writer(out)
+    writer.writerow(["benchmark", "run", "result"])
+    totals = {"hits": 0, "misses": 0, "evictions": 0}
+    with ProcessPoolExecutor(max_workers=parsed_args.jobs) as pool:
+        # map keeps the file order so the csv is deterministic
+        for name, results, counts in pool.map(run_benchmark, jobs):
+            writer.writerows(rows_for(name, results, parsed_args.metric))
+            if counts:
+                for k in totals:
+                    totals[k] += counts[k]
+    if out is not sys.stdout:
+        out.close()
+    if parsed_args.cache:
+        pipeline.report_cache(totals)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""
+Scaling Benchmarks
+Cynthia Shao and Jonathan Brown
+
+Generates synthetic Bril programs of a controlled shape and size and times
+lvn, gvn, dce and stitch_trace on them from 1k up to 1M instructions:
+
+  straight   one huge straight-line block, every other instruction redundant
+  loops      deep loop nests, lots of small blocks and back-edges
+  functions  many small functions called from main
+  trace      a long recorded trace through a branchy main, for stitch_trace
+
+Every (pass, shape, size) case runs in its own process so its peak RSS can be
+read from the OS. The report gives seconds, instructions per second and peak
+RSS, and compares the time per instruction against bench/baseline.json so a
+pass that goes quadratic shows up as a regression:
+
+  python bench/scaling.py                       # compare against the baseline
+  python bench/scaling.py --sizes 1000 10000    # smaller run
+  python bench/scaling.py --write-baseline      # record a new baseline
+
+--jobs times lvn, gvn and dce on the many-functions shape over parallel's
+process pool instead, once per worker count, and reports the speedup over one
+worker. Those cases aren't compared against the baseline, the speedup depends
+on the machine's cores:
+
+  python bench/scaling.py --jobs 1 2 4 8 --sizes 100000
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import ir
+import lvn
+import dce
+import parallel
+import trace
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# a case is slower than the baseline if its time per instruction grew by more than this
+TOLERANCE = 2.0
+# and scales badly if time per instruction grows by more than this from one size to the next,
+# a quadratic pass grows 10x per decade while cache and allocator effects stay well under this
+SCALING_LIMIT = 3.0
+# cases faster than this are rerun, up to MAX_REPEATS times
+MIN_SECONDS = 0.5
+MAX_REPEATS = 5
+
+# ==== PROGRAM SHAPES ====
+
+def straight_line_program(n):
+    """
+    A main with n instructions in one block: a few constants, then a chain of
+    arithmetic where every other instruction recomputes an earlier expression
+    """
+    instrs = [
+        {"dest": "c0", "op": "const", "type": "int", "value": 1},
+        {"dest": "c1", "op": "const", "type": "int", "value": 2},
+    ]
+    ops = ["add", "mul", "sub"]
+    i = 0
+    while len(instrs) < n - 1:
+        prev = f"v{i - 1}" if i > 0 else "c0"
+        op = ops[i % len(ops)]
+        instrs.append({"dest": f"v{i}", "op": op, "type": "int", "args": [prev, "c1"]})
+        # same expression again, LVN should turn it into an id
+        instrs.append({"dest": f"w{i}", "op": op, "type": "int", "args": [prev, "c1"]})
+        i += 1
+    instrs.append({"op": "print", "args": [f"v{i - 1}"]})
+    return {"functions": [{"name": "main", "instrs": instrs}]}
+
+def loop_nest_program(n, depth=4):
+    """A main made of loop nests `depth` deep until it has about n instructions"""
+    instrs = [
+        {"dest": "one", "op": "const", "type": "int", "value": 1},
+        {"dest": "bound", "op": "const", "type": "int", "value": 3},
+        {"dest": "acc", "op": "const", "type": "int", "value": 0},
+    ]
+    k = 0
+    while len(instrs) < n - 1:
+        for d in range(depth):
+            i = f"i{k}_{d}"
+            instrs.append({"dest": i, "op": "const", "type": "int", "value": 0})
+            instrs.append({"label": f"head{k}_{d}"})
+            instrs.append({"dest": f"c{k}_{d}", "op": "lt", "type": "bool", "args": [i, "bound"]})
+            instrs.append({"op": "br", "args": [f"c{k}_{d}"], "labels": [f"body{k}_{d}", f"end{k}_{d}"]})
+            instrs.append({"label": f"body{k}_{d}"})
+        inner = f"i{k}_{depth - 1}"
+        instrs.append({"dest": f"t{k}", "op": "mul", "type": "int", "args": [inner, "bound"]})
+        instrs.append({"dest": f"u{k}", "op": "mul", "type": "int", "args": [inner, "bound"]})
+        instrs.append({"dest": "acc", "op": "add", "type": "int", "args": ["acc", f"t{k}"]})
+        instrs.append({"dest": "acc", "op": "add", "type": "int", "args": ["acc", f"u{k}"]})
+        for d in reversed(range(depth)):
+            i = f"i{k}_{d}"
+            instrs.append({"dest": i, "op": "add", "type": "int", "args": [i, "one"]})
+            instrs.append({"op": "jmp", "labels": [f"head{k}_{d}"]})
+            instrs.append({"label": f"end{k}_{d}"})
+        k += 1
+    instrs.append({"op": "print", "args": ["acc"]})
+    return {"functions": [{"name": "main", "instrs": instrs}]}
+
+def many_functions_program(n, body=16):
+    """n instructions spread over small functions of `body` instructions each, all called from main"""
+    functions = []
+    main = [{"dest": "acc", "op": "const", "type": "int", "value": 0}]
+    total = 1
+    k = 0
+    while total < n - 1:
+        instrs = [{"dest": "one", "op": "const", "type": "int", "value": 1}]
+        prev = "x"
+        for j in range(body - 3):
+            instrs.append({"dest": f"v{j}", "op": "add", "type": "int", "args": [prev, "one"]})
+            prev = f"v{j}"
+        instrs.append({"dest": "dead", "op": "mul", "type": "int", "args": [prev, prev]})
+        instrs.append({"op": "ret", "args": [prev]})
+        functions.append({"name": f"f{k}", "args": [{"name": "x", "type": "int"}], "type": "int", "instrs": instrs})
+        main.append({"dest": "acc", "op": "call", "type": "int", "args": ["acc"], "funcs": [f"f{k}"]})
+        total += len(instrs) + 1
+        k += 1
+    main.append({"op": "print", "args": ["acc"]})
+    return {"functions": [{"name": "main", "instrs": main}] + functions}
+
+def branchy_program(n, block=8):
+    """
+    A main that runs straight through n instructions broken into blocks by
+    branches whose false side goes to a cold block at the end
+    """
+    instrs = [
+        {"dest": "one", "op": "const", "type": "int", "value": 1},
+        {"dest": "x", "op": "const", "type": "int", "value": 0},
+    ]
+    k = 0
+    while len(instrs) < n - 3:
+        for j in range(block - 3):
+            instrs.append({"dest": "x", "op": "add", "type": "int", "args": ["x", "one"]})
+        instrs.append({"dest": f"c{k}", "op": "gt", "type": "bool", "args": ["x", "one"]})
+        instrs.append({"op": "br", "args": [f"c{k}"], "labels": [f"b{k}", "cold"]})
+        instrs.append({"label": f"b{k}"})
+        k += 1
+    instrs.append({"op": "print", "args": ["x"]})
+    instrs.append({"op": "ret"})
+    instrs.append({"label": "cold"})
+    instrs.append({"op": "ret"})
+    return {"functions": [{"name": "main", "instrs": instrs}]}
+
+SHAPES = {
+    "straight": straight_line_program,
+    "loops": loop_nest_program,
+    "functions": many_functions_program,
+    "trace": branchy_program,
+}
+
+# ==== PASSES ====
+
+def run_lvn(program):
+    lvn.lvn(program)
+
+def run_gvn(program):
+    lvn.gvn(program)
+
+def run_dce(program):
+    dce.dce(program)
+
+def run_stitch(program):
+    """guard and stitch the trace brili would record for branchy_program, without running brili"""
+    main_func = program.function("main")
+    # the hot path is everything up to the first ret
+    end = next(i for (i, instr) in enumerate(main_func.instrs) if instr.op == ir.RET)
+    recorded = [instr.copy() for instr in main_func.instrs[:end + 1]]
+    side_effects = []
+    var_types = trace.function_var_types(main_func)
+    transformed = trace.guard_trace(trace.complete_trace(iter(recorded), main_func), program.names, var_types, side_effects)
+    trace.stitch_trace(program, transformed, side_effects)
+
+# pass -> (function, shapes it runs on)
+PASSES = {
+    "lvn": (run_lvn, ["straight", "loops", "functions"]),
+    "gvn": (run_gvn, ["straight", "loops", "functions"]),
+    "dce": (run_dce, ["straight", "loops", "functions"]),
+    "stitch": (run_stitch, ["trace"]),
+}
+
+def run_case(pass_name, shape, n):
+    """
+    time one pass on one program in this process, returns the result dict.
+    Small cases are repeated on fresh copies of the program, keeping the best
+    time, so timer noise doesn't read as a regression.
+    """
+    source = SHAPES[shape](n)
+    run = PASSES[pass_name][0]
+    elapsed = None
+    total = 0.0
+    for _ in range(MAX_REPEATS):
+        program = ir.from_json(source)
+        instr_count = sum(len(func.instrs) for func in program.functions)
+        start = time.perf_counter()
+        run(program)
+        seconds = time.perf_counter() - start
+        elapsed = seconds if elapsed is None else min(elapsed, seconds)
+        total += seconds
+        if total >= MIN_SECONDS:
+            break
+    return {
+        "pass": pass_name,
+        "shape": shape,
+        "size": n,
+        "instrs": instr_count,
+        "seconds": elapsed,
+        "instrs_per_sec": instr_count / elapsed if elapsed > 0 else None,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+# passes --jobs times on the process pool
+JOBS_PASSES = ["lvn", "gvn", "dce"]
+
+def run_isolated(pass_name, shape, n, jobs=1):
+    """run_case in a fresh interpreter so peak RSS belongs to this case alone"""
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--case", pass_name, shape, str(n), "--case-jobs", str(jobs)],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr, file=sys.stderr)
+        sys.exit(1)
+    return json.loads(result.stdout)
+
+# ==== REPORTING ====
+
+def case_key(result):
+    return f"{result['pass']}/{result['shape']}/{result['size']}"
+
+def us_per_instr(result):
+    return result["seconds"] / result["instrs"] * 1e6
+
+def check_scaling(results):
+    """(pass, shape) pairs whose time per instruction grows too much between consecutive sizes"""
+    problems = []
+    by_case = {}
+    for r in results:
+        by_case.setdefault((r["pass"], r["shape"]), []).append(r)
+    for ((pass_name, shape), rs) in by_case.items():
+        rs.sort(key=lambda r: r["size"])
+        for (small, large) in zip(rs, rs[1:]):
+            ratio = us_per_instr(large) / us_per_instr(small)
+            if ratio > SCALING_LIMIT:
+                problems.append(f"{pass_name}/{shape}: {ratio:.1f}x slower per instruction at {large['size']} than at {small['size']}")
+    return problems
+
+def check_baseline(results, baseline):
+    problems = []
+    for r in results:
+        old = baseline.get(case_key(r))
+        if old is None:
+            continue
+        ratio = us_per_instr(r) / us_per_instr(old)
+        if ratio > TOLERANCE:
+            problems.append(f"{case_key(r)}: {us_per_instr(r):.2f} us/instr vs {us_per_instr(old):.2f} in the baseline")
+    return problems
+
+def print_table(results, baseline):
+    print(f"{'case':<28} {'instrs':>9} {'seconds':>9} {'instr/s':>11} {'us/instr':>9} {'baseline':>9} {'rss MiB':>8}")
+    for r in results:
+        old = baseline.get(case_key(r))
+        old_us = f"{us_per_instr(old):.2f}" if old else "-"
+        print(f"{case_key(r):<28} {r['instrs']:>9} {r['seconds']:>9.3f} {r['instrs_per_sec'] or 0:>11.0f} "
+              f"{us_per_instr(r):>9.2f} {old_us:>9} {r['peak_rss_kb'] / 1024:>8.1f}")
+
+def print_jobs_table(results):
+    """time and speedup over the one worker run of every (pass, size) at each worker count"""
+    print(f"{'case':<28} {'jobs':>5} {'seconds':>9} {'speedup':>8}")
+    single = {}
+    for r in results:
+        if r["jobs"] == 1:
+            single[(r["pass"], r["size"])] = r["seconds"]
+    for r in results:
+        base = single.get((r["pass"], r["size"]))
+        speedup = f"{base / r['seconds']:.2f}" if base else "-"
+        print(f"{case_key(r):<28} {r['jobs']:>5} {r['seconds']:>9.3f} {speedup:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Time lvn, gvn, dce and stitch_trace on synthetic Bril programs')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Program sizes in instructions (default: 1k 10k 100k 1M)')
+    parser.add_argument('--passes', nargs='+', choices=list(PASSES), default=list(PASSES),
+                        help='Passes to time (default: all)')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline json to compare against')
+    parser.add_argument('--write-baseline', action='store_true', help='Store these results as the baseline')
+    parser.add_argument('--jobs', type=int, nargs='+',
+                        help='Time lvn, gvn and dce on the functions shape with each of these worker counts')
+    parser.add_argument('--case', nargs=3, metavar=('PASS', 'SHAPE', 'SIZE'), help=argparse.SUPPRESS)
+    parser.add_argument('--case-jobs', type=int, default=1, help=argparse.SUPPRESS)
+    parsed_args = parser.parse_args()
+
+    if parsed_args.case:
+        pass_name, shape, n = parsed_args.case
+        # the pool starts on the first repeat, run_case keeps the best time
+        parallel.set_jobs(parsed_args.case_jobs)
+        result = run_case(pass_name, shape, int(n))
+        result["jobs"] = parsed_args.case_jobs
+        print(json.dumps(result))
+        return
+
+    if parsed_args.jobs:
+        passes = [p for p in parsed_args.passes if p in JOBS_PASSES]
+        results = [run_isolated(pass_name, "functions", n, jobs)
+                   for pass_name in passes for n in parsed_args.sizes for jobs in parsed_args.jobs]
+        print_jobs_table(results)
+        return
+
+    results = []
+    for pass_name in parsed_args.passes:
+        for shape in PASSES[pass_name][1]:
+            for n in parsed_args.sizes:
+                results.append(run_isolated(pass_name, shape, n))
+
+    baseline = {}
+    if os.path.exists(parsed_args.baseline):
+        with open(parsed_args.baseline) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+
+    if parsed_args.write_baseline:
+        baseline.update({case_key(r): r for r in results})
+        with open(parsed_args.baseline, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        return
+
+    problems = check_scaling(results) + check_baseline(results, baseline)
+    for p in problems:
+        print(f"REGRESSION {p}")
+    if problems:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
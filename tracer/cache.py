@@ -0,0 +1,133 @@
+"""
+Optimized Program Cache
+Cynthia Shao and Jonathan Brown
+
+An on-disk, content-addressed cache of pipeline results. Entries are keyed by
+a hash of the program json, the program arguments, the pass list with the
+trace options, and the version of every pass (a hash of its source and of
+every module it imports from here, so editing any code a pass runs
+invalidates what it produced). Each entry stores the optimized program
+and the trace brili recorded for it. The directory is kept under a size bound
+by evicting the least recently used entries, with file mtimes as the access
+time.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import types
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+def source_version(module):
+    """hash of a module's source file"""
+    with open(module.__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def dependencies(module):
+    """
+    module and every module of this directory it imports, directly or through
+    the others, sorted by file name
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    found = {}
+    stack = [module]
+    while stack:
+        m = stack.pop()
+        path = os.path.abspath(m.__file__)
+        if path in found:
+            continue
+        found[path] = m
+        for value in vars(m).values():
+            if isinstance(value, types.ModuleType) and getattr(value, "__file__", None) \
+                    and os.path.dirname(os.path.abspath(value.__file__)) == here:
+                stack.append(value)
+    return [found[path] for path in sorted(found)]
+
+def module_versions(module):
+    """
+    source versions of module and everything it imports from this directory,
+    so a pass's cache entries go stale when any code it runs changes
+    """
+    return [source_version(m) for m in dependencies(module)]
+
+def cache_key(bril_json, program_args, pass_list, trace_options, versions):
+    """
+    bril_json is re-serialized with sorted keys so formatting differences in
+    the input don't miss the cache
+    """
+    payload = json.dumps({
+        "program": json.loads(bril_json),
+        "args": list(program_args),
+        "passes": list(pass_list),
+        "trace_options": trace_options,
+        "versions": versions,
+    }, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class Cache:
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        """the cached entry dict for key, or None"""
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            # mark it as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, program, trace):
+        """store the optimized program json and the recorded trace under key"""
+        self.put_entry(key, {"program": program, "trace": trace})
+        self.evict()
+
+    def put_entry(self, key, entry):
+        """store any json entry dict under key, without evicting"""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(entry))
+        # rename so concurrent readers never see a half written entry
+        os.replace(tmp, self.path(key))
+
+    def evict(self):
+        """drop least recently used entries until the directory fits in max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        for (_, size, name) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                self.evictions += 1
+            except OSError:
+                pass
+            total -= size
+
+    def counts(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,274 @@
+"""
+Control Flow Graphs
+Cynthia Shao and Jonathan Brown
+
+Splits a function into basic blocks and indexes them in one linear pass:
+label -> block index, the instruction index each block starts at, and
+successor/predecessor lists of block indices. Labels are looked up per
+function, so two functions can use the same label name. lvn.py, dce.py,
+guards.py and trace.py all build their blocks here.
+
+A block starts at a label or after a terminator and ends at a terminator or
+before the next label. Blocks share their instruction lists with nothing:
+passes edit block.instrs and call write_back to put the function back
+together.
+"""
+
+import ir
+
+class Block:
+    __slots__ = ("index", "start", "instrs")
+
+    def __init__(self, index, start, instrs):
+        self.index = index
+        self.start = start      # index of the first instruction in func.instrs
+        self.instrs = instrs
+
+    def label(self):
+        if self.instrs and self.instrs[0].op == ir.LABEL:
+            return self.instrs[0].labels[0]
+        return None
+
+    def last(self):
+        if self.instrs:
+            return self.instrs[-1]
+        return None
+
+    def __str__(self):
+        return f"Block(index={self.index}, label={self.label()}, instrs={len(self.instrs)})"
+    __repr__ = __str__
+
+class CFG:
+    def __init__(self, func):
+        self.func = func
+        self.blocks = []
+        self.label_index = {}   # label -> index of the block it starts
+        block = []
+        start = 0
+        for (i, instr) in enumerate(func.instrs):
+            if instr.op == ir.LABEL:
+                if block:
+                    self.add_block(start, block)
+                block = [instr]
+                start = i
+            else:
+                if not block:
+                    start = i
+                block.append(instr)
+                if instr.op in ir.TERMINATORS:
+                    self.add_block(start, block)
+                    block = []
+        if block:
+            self.add_block(start, block)
+
+        self.succs = []
+        self.preds = [[] for _ in self.blocks]
+        for (i, b) in enumerate(self.blocks):
+            last = b.last()
+            if last.op == ir.JMP or last.op == ir.BR:
+                succs = []
+                for l in last.labels:
+                    target = self.label_index.get(l)
+                    if target is not None and target not in succs:
+                        succs.append(target)
+            elif last.op == ir.RET:
+                succs = []
+            else:
+                succs = [i + 1] if i + 1 < len(self.blocks) else []
+            self.succs.append(succs)
+            for s in succs:
+                self.preds[s].append(i)
+
+    def add_block(self, start, instrs):
+        b = Block(len(self.blocks), start, instrs)
+        if instrs[0].op == ir.LABEL:
+            self.label_index[instrs[0].labels[0]] = b.index
+        self.blocks.append(b)
+
+    def block_of(self, label):
+        """the block a label starts, None if the function has no such label"""
+        index = self.label_index.get(label)
+        return self.blocks[index] if index is not None else None
+
+    def label_position(self, label):
+        """index in func.instrs of a label, as of when the CFG was built"""
+        return self.blocks[self.label_index[label]].start
+
+    def reverse_postorder(self):
+        """
+        block indices in reverse postorder from the entry, then any blocks the
+        entry doesn't reach. Iterative so deep CFGs don't recurse.
+        """
+        n = len(self.blocks)
+        order = []
+        visited = [False] * n
+        for start in range(n):
+            if visited[start]:
+                continue
+            visited[start] = True
+            stack = [(start, iter(self.succs[start]))]
+            while stack:
+                node, it = stack[-1]
+                for s in it:
+                    if not visited[s]:
+                        visited[s] = True
+                        stack.append((s, iter(self.succs[s])))
+                        break
+                else:
+                    stack.pop()
+                    order.append(node)
+        order.reverse()
+        return order
+
+    def guard_targets(self):
+        """
+        indices of the blocks a failed guard jumps to, entered with the state
+        rolled back to the speculate
+        """
+        targets = set()
+        for b in self.blocks:
+            for instr in b.instrs:
+                if instr.op == ir.GUARD:
+                    targets.update(self.label_index[l] for l in instr.labels if l in self.label_index)
+        return sorted(targets)
+
+    def write_back(self):
+        """replace the function's instructions with its (edited) blocks"""
+        self.func.instrs = [instr for b in self.blocks for instr in b.instrs]
+        return self.func
+
+def build(func):
+    return CFG(func)
+
+def program_cfgs(program):
+    """function name -> CFG for every function of an ir.Program"""
+    return {func.name: CFG(func) for func in program.functions}
+
+# ==== DOMINATORS ====
+
+class DomTree:
+    """
+    Dominator tree of a CFG by Cooper, Harvey and Kennedy's iterative
+    algorithm over reverse postorder. The entry block, every block in roots
+    and every block none of them reach hang off a virtual root with index
+    len(graph.blocks), so each block has an idom and the tree covers the
+    whole function. Extra roots are for blocks entered some way the CFG
+    doesn't show, like the target of a guard.
+    """
+
+    def __init__(self, graph, roots=()):
+        n = len(graph.blocks)
+        self.root = n
+        self.preds = [list(p) for p in graph.preds] + [[]]
+        succs = list(graph.succs) + [[]]
+
+        # postorder number of every node, iteratively so deep CFGs don't recurse
+        self.postorder = []
+        number = [None] * (n + 1)
+        visited = [False] * (n + 1)
+        # the entry and the extra roots hang off the virtual root even when
+        # the search already reached them: a guard target is also entered by
+        # a rollback, which none of the blocks before it dominate
+        entries = ([0] if n else []) + [r for r in dict.fromkeys(roots) if r != 0]
+        succs[self.root] = list(entries)
+        is_entry = set(entries)
+        for r in entries:
+            self.preds[r].append(self.root)
+        for start in entries + list(range(n)):
+            if visited[start]:
+                continue
+            if start not in is_entry:
+                succs[self.root].append(start)
+                self.preds[start].append(self.root)
+            visited[start] = True
+            stack = [(start, iter(succs[start]))]
+            while stack:
+                node, it = stack[-1]
+                for s in it:
+                    if not visited[s]:
+                        visited[s] = True
+                        stack.append((s, iter(succs[s])))
+                        break
+                else:
+                    stack.pop()
+                    number[node] = len(self.postorder)
+                    self.postorder.append(node)
+        number[self.root] = len(self.postorder)
+        self.postorder.append(self.root)
+        self.number = number
+
+        idom = [None] * (n + 1)
+        idom[self.root] = self.root
+        rpo = self.postorder[-2::-1]
+        changed = True
+        while changed:
+            changed = False
+            for b in rpo:
+                new_idom = None
+                for p in self.preds[b]:
+                    if idom[p] is None:
+                        continue
+                    new_idom = p if new_idom is None else self.intersect(idom, p, new_idom)
+                if idom[b] != new_idom:
+                    idom[b] = new_idom
+                    changed = True
+        self.idom = idom
+
+        self.children = [[] for _ in range(n + 1)]
+        for b in rpo:
+            self.children[idom[b]].append(b)
+        self._frontiers = None
+
+    def intersect(self, idom, a, b):
+        number = self.number
+        while a != b:
+            while number[a] < number[b]:
+                a = idom[a]
+            while number[b] < number[a]:
+                b = idom[b]
+        return a
+
+    def dominates(self, a, b):
+        while b != a and b != self.root:
+            b = self.idom[b]
+        return b == a
+
+    def frontiers(self):
+        """dominance frontier of every block, as sets of block indices"""
+        if self._frontiers is None:
+            df = [set() for _ in self.idom]
+            for (b, preds) in enumerate(self.preds):
+                if len(preds) < 2:
+                    continue
+                for p in preds:
+                    runner = p
+                    while runner != self.idom[b]:
+                        df[runner].add(b)
+                        runner = self.idom[runner]
+            self._frontiers = df
+        return self._frontiers
+
+    def iterated_frontier(self, blocks):
+        """blocks where definitions in `blocks` meet, the iterated dominance frontier"""
+        df = self.frontiers()
+        result = set()
+        worklist = list(blocks)
+        seen = set(worklist)
+        while worklist:
+            b = worklist.pop()
+            for d in df[b]:
+                if d not in result:
+                    result.add(d)
+                    if d not in seen:
+                        seen.add(d)
+                        worklist.append(d)
+        return result
+
+    def preorder(self):
+        """(block, depth) for the real blocks in dominator tree preorder"""
+        stack = [(c, 1) for c in reversed(self.children[self.root])]
+        while stack:
+            b, depth = stack.pop()
+            yield b, depth
+            for c in reversed(self.children[b]):
+                stack.append((c, depth + 1))
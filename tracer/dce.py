@@ -4,212 +4,195 @@ Dead Code Elimination
 Cynthia Shao and Jonathan Brown
 
 This script takes in a Bril JSON file and outputs a new Bril program 
-to stdout with dead code eliminated within every basic block.
+to stdout with dead code eliminated within every basic block. With --stream
+it reads, optimizes and writes one function at a time.
 """
 
-import json
 import sys
-import copy
-from collections import defaultdict
-
-class Block:
-	def __init__(self, idx, instrs):
-		self.idx = idx
-		self.instrs = instrs
-		self.edges = []
-
-	def labels(self):
-		if self.instrs and "labels" in self.instrs[0]:
-			return self.instrs[0]["labels"]
-		return None
-
-	def label(self):
-		if self.instrs and "label" in self.instrs[0]:
-			return self.instrs[0]["label"]
-		return None
-
-	def last(self):
-		if self.instrs:
-			return self.instrs[-1]
-		return None
-
-	def get_args(self):
-		if self.instrs and "args" in self.instrs[0]:
-			return self.instrs[0]["args"]
-		return None
-
-	def add_edge(self, target):
-		if target not in self.edges:
-			self.edges.append(target)
-	
-	def __str__(self):
-		return f"Block(idx={self.idx}, label={self.label()}, edges = {self.edges} )"          
 
+import cache
+import cfg
+import df
+import incremental
+import ir
+import parallel
+import stats
+import wire
 
 def print_block_instrs(blks):
     for (i, instr) in enumerate(blks.instrs):
         print(i, instr)
 
-def print_instructions():
+def print_instructions(bril):
     print("INSTRS")
-    for (i, func) in enumerate(bril["functions"]):
-        print(i, func)
-        if "instrs" in func:
-            for (j, instr) in enumerate(func["instrs"]):
-                print(j, instr)
-
-bril = json.load(sys.stdin)
-
-def split_func_calls(funcs): #get funcy
-    res = ""
-    for (i,func) in enumerate(funcs):
-        if i < (len(funcs) - 1):
-            res += func + ", "
-        else:
-            res += func
-    return res
-
-def get_block_name(self,lbl):
-    if self: 
-        first = self[0]
-        if "label" in first:
-            return first["label"]
-        elif "dest" in first:
-            return first["dest"]
-        elif "funcs" in first:
-            return split_func_calls(first["funcs"])
-        else:
-            return first["op"]
-    else:
-        return lbl
-
-used_names = defaultdict(int)
-
-def get_unique_block_name(self,lbl):
-    if self: 
-        first = self[0]
-        if "label" in first:
-            return first["label"]
-        elif "dest" in first:
-            d = first["dest"]
-            if d in used_names:
-                used_names[d] += 1
-                return d + "_" + used_names[d]
-            return first["dest"]
-        elif "funcs" in first:
-            return split_func_calls(first["funcs"])
-        else:
-            return first["op"]
-    else:
-        return lbl
-
-blocks = []
-block = []
-selfIdx = 0
-func_counter = 0
-
-func_to_blocks = {}
-for func in bril["functions"]:
-    blocks = []
-    block = []
-    selfIdx = 0
-    key = func["name"]
-    if "instrs" in func:
-        for instr in func["instrs"]:  # loop over instructions in the function
-            if "label" in instr:
-                b0 = Block(get_unique_block_name(block, instr["label"]), block)
-                selfIdx += 1
-                blocks.append(b0)
-                block = []
-                block.append(instr)
-            elif "op" in instr:
-                if instr["op"] == "br" or instr["op"] == "jmp" or instr["op"] == "ret":
-                    b1 = Block(get_unique_block_name(block, ""), block)
-                    selfIdx += 1
-                    block.append(instr)
-                    blocks.append(b1)
-                    block = []
-                else:
-                    selfIdx += 1
-                    block.append(instr)
-    if block:
-        b2 = Block(get_block_name(block, ""), block)
-        selfIdx += 1
-        blocks.append(b2)
-        block = []
-    func_to_blocks[key] = blocks
-
-def print_func_block():
-    for k in func_to_blocks.keys():
+    for (i, func) in enumerate(bril.functions):
+        print(i, func.name)
+        for (j, instr) in enumerate(func.instrs):
+            print(j, instr)
+
+def print_func_block(func_cfgs):
+    for k in func_cfgs.keys():
         print(k)
-        for b in func_to_blocks[k]:
+        for b in func_cfgs[k].blocks:
             print_block_instrs(b)
 
-def create_json_from_blocks(func_to_blocks, og_func):
-    funcs_json = []
-    for func_name, blocks in func_to_blocks.items():
-        orig_func = next((f for f in og_func if f["name"] == func_name), {})
-        func_dict = {"instrs": [], "name": func_name}
-        if "args" in orig_func:
-            func_dict["args"] = orig_func["args"]
-        if "type" in orig_func:
-            func_dict["type"] = orig_func["type"]
-        for block in blocks:
-            func_dict["instrs"].extend(block.instrs)
-        funcs_json.append(func_dict)
-    return {"functions": funcs_json}
-
-def global_dce(blocks):
-    changed = False
-    alive = set()
-    for b in blocks:
-        for instr in b.instrs:
-            args = None
-            if "args" in instr:
-                args = instr["args"]
-            
-            if args is not None:
-                for arg in args:
-                    alive.add(arg) 
-    
-    for b in blocks:
-        for instr in b.instrs:
-            if "dest" in instr:
-                if instr["dest"] not in alive:
-                    b.instrs.remove(instr)
-                    changed = True        
-    return changed
-        
-    
-
-def local_dce(blocks):
-    changed = False
-    for b in blocks:
-        seen = set()
+def is_removable(instr):
+    return instr.dest is not None and instr.op in ir.PURE
+
+def transfer(b, live, rollback_live):
+    """Strong liveness through one block, backwards. Dead pure instrs don't use their args."""
+    live = set(live)
+    for instr in reversed(b.instrs):
+        if instr.op in df.ROLLBACK_OPS:
+            live |= rollback_live
+        if is_removable(instr):
+            if instr.dest not in live:
+                continue
+            live.discard(instr.dest)
+        elif instr.dest is not None:
+            live.discard(instr.dest)
+        if instr.args:
+            live.update(instr.args)
+    return live
+
+class StrongLiveness(df.Analysis):
+    """
+    Liveness where a dead pure instruction doesn't make its args live, so a
+    whole dead chain goes in one solve. That isn't a gen/kill problem, so the
+    sets are python sets and the transfer walks the block.
+    """
+    forward = False
+
+    def __init__(self, graph):
+        self.blocks = graph.blocks
+
+    def boundary(self):
+        return set()
+
+    def initial(self):
+        return set()
+
+    def meet(self, values):
+        live = set()
+        for v in values:
+            live |= v
+        return live
+
+    def transfer(self, i, value):
+        return transfer(self.blocks[i], value, frozenset())
+
+    def at_rollback(self, i, value):
+        # every instr's transfer distributes over union, so walking with
+        # rollback_live alone and adding it to transfer() is the combined walk
+        return transfer(self.blocks[i], frozenset(), value)
+
+def liveness(graph):
+    """
+    Strong liveness over a cfg.CFG, returns live_out and live_in for every
+    block and the guard targets
+    """
+    live_in, live_out = df.solve(graph, StrongLiveness(graph))
+    return live_out, live_in, graph.guard_targets()
+
+def global_dce(graph):
+    """
+    Delete every pure instruction whose result is dead, using one liveness
+    solve over the whole function. Returns the number of instructions removed.
+    """
+    live_out, live_in, guard_targets = liveness(graph)
+    rollback_live = set()
+    for t in guard_targets:
+        rollback_live |= live_in[t]
+    removed = 0
+    for (i, b) in enumerate(graph.blocks):
+        live = set(live_out[i])
+        kept = []
         for instr in reversed(b.instrs):
-            if "dest" in instr:
-                if instr["dest"] is not None:
-                    if instr["dest"] not in seen:
-                        seen.add(instr["dest"])
-                    else:
-                        if instr["op"] is not None:
-                            if instr["op"] == "const":
-                                b.instrs.remove(instr)
-                                changed = True
-    return changed
-
-
-for f in func_to_blocks.keys():
-    changed = True
-    while(changed):
-        changed = False
-        changed = changed or global_dce(func_to_blocks[f])
-    changed = True
-    while(changed):
-        changed = False
-        changed = changed or local_dce(func_to_blocks[f])
-        
-
-new_json = create_json_from_blocks(func_to_blocks, bril["functions"])
-
-json.dump(new_json, sys.stdout, indent=4)
\ No newline at end of file
+            if instr.op in df.ROLLBACK_OPS:
+                live |= rollback_live
+            if is_removable(instr):
+                if instr.dest not in live:
+                    removed += 1
+                    continue
+                live.discard(instr.dest)
+            elif instr.dest is not None:
+                live.discard(instr.dest)
+            if instr.args:
+                live.update(instr.args)
+            kept.append(instr)
+        kept.reverse()
+        b.instrs[:] = kept
+    return removed
+
+def local_dce(graph):
+    """
+    Drop pure instructions whose dest is overwritten later in the same block
+    before any use or speculate/guard. Returns the number of instructions removed.
+    """
+    removed = 0
+    for b in graph.blocks:
+        # vars that are redefined below this point before being read
+        overwritten = set()
+        kept = []
+        for instr in reversed(b.instrs):
+            # a failed guard rolls back to the state at the speculate, where
+            # the defs before it are still read
+            if instr.op in df.ROLLBACK_OPS:
+                overwritten.clear()
+            if is_removable(instr) and instr.dest in overwritten:
+                removed += 1
+                continue
+            if instr.dest is not None:
+                overwritten.add(instr.dest)
+            if instr.args:
+                overwritten.difference_update(instr.args)
+            kept.append(instr)
+        kept.reverse()
+        b.instrs[:] = kept
+    return removed
+
+
+def dce_chunk(program):
+    """parallel.map_functions worker: run dce on the functions of program, return the counters"""
+    visits = df.block_visits
+    local_removed = 0
+    global_removed = 0
+    for func in program.functions:
+        graph = cfg.CFG(func)
+        local_removed += local_dce(graph)
+        global_removed += global_dce(graph)
+        graph.write_back()
+    return {
+        "dce_local_removed": local_removed,
+        "dce_global_removed": global_removed,
+        "dce_fixpoint_iterations": df.block_visits - visits,
+    }
+
+def dce(bril):
+    """
+    Run local then global dead code elimination on every function of an
+    ir.Program, on parallel's process pool when it is on and the module is
+    big enough
+    """
+    if parallel.worth_it(bril):
+        totals = parallel.map_functions(bril, dce_chunk)
+    else:
+        totals = dce_chunk(bril)
+    for (name, value) in totals.items():
+        stats.count(name, value)
+    return bril
+
+if __name__ == "__main__":
+    if "--stream" in sys.argv[1:]:
+        wire.check_stream_argv(sys.argv[1:])
+        wire.stream_program(dce, wire.output_format(sys.argv[1:]))
+        sys.exit(0)
+    bril = wire.read_program()
+    parallel.set_jobs(parallel.jobs_from_argv(sys.argv[1:]))
+    memo_dir = incremental.memo_dir(sys.argv[1:])
+    if memo_dir:
+        versions = {"dce": cache.module_versions(sys.modules[__name__])}
+        incremental.run(bril, ["dce"], dce, versions, cache.Cache(memo_dir))
+    else:
+        dce(bril)
+    wire.write_program(bril, wire.output_format(sys.argv[1:]))
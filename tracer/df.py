@@ -0,0 +1,408 @@
+"""
+Dataflow
+Cynthia Shao and Jonathan Brown
+
+A worklist solver for dataflow problems over a cfg.CFG, the Python side of
+dataflow/src/df.rs. An analysis gives a direction, a meet and a block
+transfer function; solve sweeps the blocks in reverse postorder (postorder
+for backward problems) and only revisits blocks whose inputs changed, so a
+function converges in a few linear sweeps.
+
+Gen/kill problems keep their sets as Python ints used as bit vectors, with
+variables or definitions numbered per function, and precompute gen and kill
+for every block once. Provided:
+
+  Liveness        backward, live variables
+  ReachingDefs    forward, definitions that reach each block
+  ConstProp       forward, variables with a known constant value
+
+A failed guard jumps to its target with the variables rolled back to their
+values at the speculate, so the solver also flows facts between speculate
+blocks and guard targets: forward analyses meet the state at each speculate
+into the guard targets, backward analyses make what the guard targets need
+live at every speculate and guard.
+"""
+
+import json
+import sys
+
+import cfg
+import ir
+import lvn
+import wire
+
+# blocks whose transfer the solver ran, summed over every solve
+block_visits = 0
+
+# ops where a forward analysis captures the state a failed guard restores
+SPECULATE_OPS = frozenset([ir.SPECULATE])
+# ops where a backward analysis needs the guard targets' inputs live
+ROLLBACK_OPS = frozenset([ir.SPECULATE, ir.GUARD])
+
+class Analysis:
+    """
+    Base for dataflow problems. Subclasses set forward and implement
+    boundary, initial, meet, transfer and at_rollback.
+    """
+    forward = True
+
+    def boundary(self):
+        """value flowing into the entry block (forward) or out of exit blocks (backward)"""
+        raise NotImplementedError
+
+    def initial(self):
+        """value every block starts from before the first sweep"""
+        raise NotImplementedError
+
+    def meet(self, values):
+        raise NotImplementedError
+
+    def transfer(self, i, value):
+        """value at the other end of block i given the value at its input end"""
+        raise NotImplementedError
+
+    def at_rollback(self, i, value):
+        """
+        Forward: the state at the speculates of block i given the value at its
+        top. Backward: what the top of block i needs given value, the meet of
+        the guard targets' inputs, is needed at its speculates and guards.
+        """
+        raise NotImplementedError
+
+def solve(graph, analysis):
+    """
+    Solve analysis over a cfg.CFG. Returns (before, after): the value at the
+    top and at the bottom of every block, indexed by block.
+    """
+    global block_visits
+    n = len(graph.blocks)
+    forward = analysis.forward
+    order = graph.reverse_postorder()
+    if not forward:
+        order.reverse()
+    ops = SPECULATE_OPS if forward else ROLLBACK_OPS
+    targets = graph.guard_targets()
+    rollback = [i for (i, b) in enumerate(graph.blocks) if targets and any(instr.op in ops for instr in b.instrs)]
+    is_target = [False] * n
+    for t in targets:
+        is_target[t] = True
+    is_rollback = [False] * n
+    for i in rollback:
+        is_rollback[i] = True
+
+    before = [analysis.initial() for _ in range(n)]
+    after = [analysis.initial() for _ in range(n)]
+    dirty = [True] * n
+    changed = True
+    while changed:
+        changed = False
+        for i in order:
+            if not dirty[i]:
+                continue
+            dirty[i] = False
+            block_visits += 1
+            if forward:
+                values = [after[p] for p in graph.preds[i]]
+                if i == 0:
+                    values.append(analysis.boundary())
+                if is_target[i]:
+                    values.extend(analysis.at_rollback(s, before[s]) for s in rollback)
+                new_before = analysis.meet(values)
+                if new_before != before[i]:
+                    before[i] = new_before
+                    if is_rollback[i]:
+                        for t in targets:
+                            dirty[t] = True
+                        changed = True
+                new_after = analysis.transfer(i, new_before)
+                if new_after != after[i]:
+                    after[i] = new_after
+                    for s in graph.succs[i]:
+                        dirty[s] = True
+                    changed = True
+            else:
+                succs = graph.succs[i]
+                if succs:
+                    out = analysis.meet([before[s] for s in succs])
+                else:
+                    out = analysis.boundary()
+                after[i] = out
+                new_before = analysis.transfer(i, out)
+                if is_rollback[i]:
+                    restored = analysis.meet([before[t] for t in targets])
+                    new_before = analysis.meet([new_before, analysis.at_rollback(i, restored)])
+                if new_before != before[i]:
+                    before[i] = new_before
+                    for p in graph.preds[i]:
+                        dirty[p] = True
+                    if is_target[i]:
+                        for s in rollback:
+                            dirty[s] = True
+                    changed = True
+    return before, after
+
+# ==== BIT VECTORS ====
+
+class Bits:
+    """Numbers the items of one function densely so bit vectors stay short"""
+    __slots__ = ("index", "items")
+
+    def __init__(self):
+        self.index = {}
+        self.items = []
+
+    def bit(self, item):
+        b = self.index.get(item)
+        if b is None:
+            b = len(self.items)
+            self.index[item] = b
+            self.items.append(item)
+        return b
+
+    def decode(self, mask):
+        """the items whose bits are set in mask"""
+        out = []
+        while mask:
+            low = mask & -mask
+            out.append(self.items[low.bit_length() - 1])
+            mask ^= low
+        return out
+
+    def __len__(self):
+        return len(self.items)
+
+class GenKill(Analysis):
+    """
+    A may analysis with bit vector sets: meet is union and block i maps x to
+    gen[i] | (x & ~kill[i]). Subclasses fill gen, kill and the rollback pair
+    roll_gen/roll_kill, the same transfer up to the speculates (forward) or
+    from the first speculate or guard back to the top (backward).
+    """
+
+    def __init__(self, graph):
+        n = len(graph.blocks)
+        self.graph = graph
+        self.bits = Bits()
+        self.gen = [0] * n
+        self.kill = [0] * n
+        self.roll_gen = [0] * n
+        self.roll_kill = [0] * n
+
+    def boundary(self):
+        return 0
+
+    def initial(self):
+        return 0
+
+    def meet(self, values):
+        m = 0
+        for v in values:
+            m |= v
+        return m
+
+    def transfer(self, i, value):
+        return self.gen[i] | (value & ~self.kill[i])
+
+    def at_rollback(self, i, value):
+        return self.roll_gen[i] | (value & ~self.roll_kill[i])
+
+class Liveness(GenKill):
+    """Variables that may be read before they are written, bits over var ids"""
+    forward = False
+
+    def __init__(self, graph):
+        super().__init__(graph)
+        bit = self.bits.bit
+        for b in graph.blocks:
+            gen = 0
+            kill = 0
+            roll_kill = None
+            for instr in b.instrs:
+                if roll_kill is None and instr.op in ROLLBACK_OPS:
+                    roll_kill = kill
+                for a in instr.args:
+                    m = 1 << bit(a)
+                    if not kill & m:
+                        gen |= m
+                if instr.dest is not None:
+                    kill |= 1 << bit(instr.dest)
+            self.gen[b.index] = gen
+            self.kill[b.index] = kill
+            # uses above the speculate are already in gen
+            self.roll_kill[b.index] = roll_kill or 0
+
+    def live(self, mask):
+        """var ids of a solved mask"""
+        return self.bits.decode(mask)
+
+class ReachingDefs(GenKill):
+    """
+    Definitions that may reach each point. Bits number definitions as
+    (block index, instruction index, var id): the function's arguments
+    first, with block None, then every instruction with a dest.
+    """
+    forward = True
+
+    def __init__(self, graph):
+        super().__init__(graph)
+        bit = self.bits.bit
+        var_defs = {}
+        self.args = 0
+        for (pos, (var, _)) in enumerate(graph.func.args):
+            m = 1 << bit((None, pos, var))
+            var_defs[var] = var_defs.get(var, 0) | m
+            self.args |= m
+        block_defs = []
+        for b in graph.blocks:
+            defs = []
+            for (pos, instr) in enumerate(b.instrs):
+                if instr.dest is not None:
+                    m = 1 << bit((b.index, pos, instr.dest))
+                    var_defs[instr.dest] = var_defs.get(instr.dest, 0) | m
+                    defs.append((pos, instr.dest, m))
+            block_defs.append(defs)
+
+        for b in graph.blocks:
+            # var -> its last def so far in the block
+            last = {}
+            roll_gen = 0
+            roll_kill = None
+            d = 0
+            defs = block_defs[b.index]
+            for (pos, instr) in enumerate(b.instrs):
+                if instr.op in SPECULATE_OPS:
+                    # reaching defs at each speculate, unioned
+                    roll_gen |= self.meet(last.values())
+                    kill = self.meet(var_defs[v] for v in last)
+                    roll_kill = kill if roll_kill is None else roll_kill & kill
+                if d < len(defs) and defs[d][0] == pos:
+                    last[defs[d][1]] = defs[d][2]
+                    d += 1
+            self.gen[b.index] = self.meet(last.values())
+            self.kill[b.index] = self.meet(var_defs[v] for v in last)
+            self.roll_gen[b.index] = roll_gen
+            self.roll_kill[b.index] = roll_kill or 0
+
+    def boundary(self):
+        return self.args
+
+    def reaching(self, mask):
+        """(block index, instruction index, var id) of every def in a solved mask"""
+        return self.bits.decode(mask)
+
+# ==== CONSTANT PROPAGATION ====
+
+class _NAC:
+    """a variable that holds different values on different paths"""
+    def __repr__(self):
+        return "NAC"
+NAC = _NAC()
+
+def same_const(a, b):
+    # True == 1 in python, but a bool is never the same constant as an int
+    return type(a) is type(b) and a == b
+
+class ConstProp(Analysis):
+    """
+    Variables with a known constant value, as dicts var id -> value or NAC.
+    A variable missing from the dict is undefined on every path so far.
+    Arguments start as NAC. Uses lvn's fold table, so folding agrees with LVN.
+
+    Each block only passes on the variables live out of it, from a Liveness
+    solve first, so the dicts stay the size of the live sets instead of
+    every variable of the function at every block.
+    """
+    forward = True
+
+    def __init__(self, graph):
+        self.graph = graph
+        live = Liveness(graph)
+        live_in, live_out = solve(graph, live)
+        self.live_out = [frozenset(live.live(m)) for m in live_out]
+        self.entry_live = frozenset(live.live(live_in[0])) if graph.blocks else frozenset()
+        self.rollback_live = frozenset(live.live(live.meet(live_in[t] for t in graph.guard_targets())))
+
+    @staticmethod
+    def prune(env, live):
+        return {var: c for (var, c) in env.items() if var in live}
+
+    def boundary(self):
+        return self.prune({var: NAC for (var, _) in self.graph.func.args}, self.entry_live)
+
+    def initial(self):
+        return {}
+
+    def meet(self, values):
+        out = None
+        for v in values:
+            if out is None:
+                out = dict(v)
+                continue
+            for (var, c) in v.items():
+                old = out.get(var, c)
+                out[var] = old if old is NAC or same_const(old, c) else NAC
+        return out if out is not None else {}
+
+    def step(self, env, instr):
+        if instr.dest is None:
+            return
+        op = instr.op
+        if op == ir.CONST:
+            env[instr.dest] = instr.value
+            return
+        consts = [env.get(a, NAC) for a in instr.args]
+        if op == ir.ID and consts:
+            env[instr.dest] = consts[0]
+        elif op in lvn.FOLD_OPS and all(c is not NAC for c in consts) and not (op == ir.DIV and consts[1] == 0):
+            env[instr.dest] = lvn.FOLD_OPS[op](*consts)
+        else:
+            env[instr.dest] = NAC
+
+    def transfer(self, i, value):
+        env = dict(value)
+        for instr in self.graph.blocks[i].instrs:
+            self.step(env, instr)
+        return self.prune(env, self.live_out[i])
+
+    def at_rollback(self, i, value):
+        env = dict(value)
+        states = []
+        for instr in self.graph.blocks[i].instrs:
+            if instr.op in SPECULATE_OPS:
+                states.append(self.prune(env, self.rollback_live))
+            self.step(env, instr)
+        return self.meet(states)
+
+    def constants(self, env):
+        """var id -> value for the variables of a solved env that are constant"""
+        return {var: c for (var, c) in env.items() if c is not NAC}
+
+ANALYSES = {
+    "live": Liveness,
+    "reaching": ReachingDefs,
+    "const": ConstProp,
+}
+
+def describe(program, name):
+    """function -> block label (or index) -> solved in/out, by variable name"""
+    names = program.names.names
+    def show(value):
+        if name == "live":
+            return sorted(names[v] for v in analysis.live(value))
+        if name == "reaching":
+            return [f"{names[v]}@{'arg' if b is None else b}.{pos}" for (b, pos, v) in analysis.reaching(value)]
+        return {names[v]: repr(c) if c is NAC else c for (v, c) in sorted(value.items())}
+
+    out = {}
+    for (fname, graph) in cfg.program_cfgs(program).items():
+        analysis = ANALYSES[name](graph)
+        before, after = solve(graph, analysis)
+        out[fname] = {b.label() or str(b.index): {"in": show(before[b.index]), "out": show(after[b.index])}
+                      for b in graph.blocks}
+    return out
+
+if __name__ == "__main__":
+    name = sys.argv[1] if len(sys.argv) > 1 else "live"
+    program = wire.read_program()
+    json.dump(describe(program, name), sys.stdout, indent=4)
+    print()
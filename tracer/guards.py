@@ -0,0 +1,142 @@
+"""
+Redundant Guard Elimination
+Cynthia Shao and Jonathan Brown
+
+This script takes in a Bril JSON file with speculative regions and removes
+guards that can't fail: guards on a value an earlier guard in the same block
+already checked, on a value implied by one (the halves of an `and`, the
+negation of a value known false), or on a constant true. Values are compared
+by value number, so guards on different copies of the same expression merge.
+A speculate/commit pair left with no guards between them is dropped too.
+
+Run it after lvn.py, which already points equivalent values at one variable:
+
+  python trace.py -f prog.bril | python lvn.py | python guards.py | python dce.py
+"""
+
+import sys
+
+import cfg
+import ir
+import stats
+import wire
+
+def guard_block(instrs):
+    """
+    Value number one basic block and return it without its redundant guards.
+    Known facts are about values, not variables, so they hold from the guard
+    to the end of the block whatever gets reassigned after it.
+    """
+    num = {}        # var -> value number
+    exprs = {}      # (op, args or const) -> value number
+    consts = {}     # value number -> constant value
+    nots = {}       # value number of `not x` -> value number of x
+    ands = {}       # value number of `and x y` -> (x, y)
+    known_true = set()
+    known_false = set()
+    next_num = [0]
+
+    def fresh():
+        next_num[0] += 1
+        return next_num[0]
+
+    def var_num(var):
+        if var not in num:
+            num[var] = fresh()
+        return num[var]
+
+    def is_true(vn):
+        if consts.get(vn) is True or vn in known_true:
+            return True
+        if vn in nots and is_false(nots[vn]):
+            return True
+        return False
+
+    def is_false(vn):
+        if consts.get(vn) is False or vn in known_false:
+            return True
+        if vn in nots and is_true(nots[vn]):
+            return True
+        return False
+
+    def learn_true(vn):
+        if vn in known_true:
+            return
+        known_true.add(vn)
+        if vn in nots:
+            known_false.add(nots[vn])
+        if vn in ands:
+            for arg in ands[vn]:
+                learn_true(arg)
+
+    kept = []
+    for instr in instrs:
+        if instr.op == ir.GUARD:
+            vn = var_num(instr.args[0])
+            if is_true(vn):
+                stats.count("guards_removed")
+                continue
+            learn_true(vn)
+        elif instr.dest is not None:
+            if instr.op == ir.ID:
+                num[instr.dest] = var_num(instr.args[0])
+            elif instr.op == ir.CONST:
+                key = (ir.CONST, instr.type, repr(instr.value))
+                if key not in exprs:
+                    exprs[key] = fresh()
+                    consts[exprs[key]] = instr.value
+                num[instr.dest] = exprs[key]
+            elif instr.op in ir.PURE:
+                args = tuple(var_num(arg) for arg in instr.args)
+                if instr.op in ir.COMMUTATIVE:
+                    args = tuple(sorted(args))
+                key = (instr.op, args)
+                if key not in exprs:
+                    exprs[key] = fresh()
+                    if instr.op == ir.NOT:
+                        nots[exprs[key]] = args[0]
+                    elif instr.op == ir.AND:
+                        ands[exprs[key]] = args
+                num[instr.dest] = exprs[key]
+            else:
+                num[instr.dest] = fresh()
+        kept.append(instr)
+    return kept
+
+def drop_empty_regions(instrs):
+    """Remove speculate/commit pairs that no longer guard anything"""
+    kept = []
+    open_regions = []  # [index in kept of each open speculate, whether it has to stay]
+    for instr in instrs:
+        if instr.op == ir.SPECULATE:
+            open_regions.append([len(kept), False])
+        elif instr.op == ir.GUARD:
+            for region in open_regions:
+                region[1] = True
+        elif instr.op == ir.COMMIT and open_regions:
+            start, guarded = open_regions.pop()
+            if not guarded:
+                stats.count("regions_removed")
+                del kept[start]
+                continue
+        elif instr.op == ir.LABEL or instr.op in ir.TERMINATORS:
+            # a region that spans blocks is left alone
+            for region in open_regions:
+                region[1] = True
+        kept.append(instr)
+    return kept
+
+def eliminate_guards(program):
+    """Remove redundant guards from every function of an ir.Program, in place"""
+    for func in program.functions:
+        graph = cfg.build(func)
+        for b in graph.blocks:
+            b.instrs = guard_block(b.instrs)
+        graph.write_back()
+        func.instrs = drop_empty_regions(func.instrs)
+    return program
+
+if __name__ == "__main__":
+    bril = wire.read_program()
+    eliminate_guards(bril)
+    wire.write_program(bril, wire.output_format(sys.argv[1:]))
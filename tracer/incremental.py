@@ -0,0 +1,83 @@
+"""
+Incremental Re-optimization
+Cynthia Shao and Jonathan Brown
+
+lvn, gvn, guards and dce only ever look at one function at a time, so their
+output for a function depends on nothing but that function. This keeps a
+persistent memo from a fingerprint of each function's canonical json (plus
+the passes and their source versions) to the optimized function, runs the
+passes only on the functions that missed, and splices the memoized ones back
+in. Re-running a big module after editing one function then only optimizes
+that function:
+
+  python lvn.py --incremental .memo < prog.json
+  python pipeline.py -f prog.bril --incremental .memo
+"""
+
+import hashlib
+import json
+import sys
+
+import ir
+import stats
+
+def flatten(func, names):
+    """
+    a function as nested lists with variable and op names, the canonical form
+    that is fingerprinted and memoized; lists encode and decode much faster
+    than a dict per instruction
+    """
+    var = names.names
+    instrs = [[ir.OP_NAMES[instr.op], var[instr.dest] if instr.dest is not None else None, instr.type,
+               [var[a] for a in instr.args], instr.funcs, instr.labels, instr.value]
+              for instr in func.instrs]
+    return [func.name, [[var[a], t] for (a, t) in func.args], func.type, instrs]
+
+def unflatten(flat, names):
+    """the instructions of a flattened function, interning into names"""
+    intern = names.intern
+    Instr = ir.Instr
+    return [Instr(ir.opcode(op), intern(dest) if dest is not None else None, ir.intern_type(typ),
+                  tuple(intern(a) for a in args), tuple(funcs), tuple(sys.intern(l) for l in labels), value)
+            for (op, dest, typ, args, funcs, labels, value) in flat[3]]
+
+def fingerprint(flat, pass_names, versions):
+    payload = json.dumps([flat, list(pass_names), versions], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def memo_dir(argv):
+    """the directory after --incremental in a script's argv, None without it"""
+    if "--incremental" not in argv:
+        return None
+    i = argv.index("--incremental")
+    if i + 1 >= len(argv):
+        raise SystemExit("--incremental needs a directory")
+    return argv[i + 1]
+
+def run(program, pass_names, run_passes, versions, memo):
+    """
+    Optimize program in place with run_passes, a function from an ir.Program
+    to the optimized ir.Program, calling it only on the functions memo (a
+    cache.Cache) has no result for. Returns the program.
+    """
+    names = program.names
+    # (index in program.functions, fingerprint) of every function that missed
+    missed = []
+    for (i, func) in enumerate(program.functions):
+        key = fingerprint(flatten(func, names), pass_names, versions)
+        entry = memo.get(key)
+        if entry is None:
+            missed.append((i, key))
+        else:
+            func.instrs = unflatten(entry["function"], names)
+    stats.count("incremental_reused", len(program.functions) - len(missed))
+    stats.count("incremental_optimized", len(missed))
+    if not missed:
+        return program
+
+    optimized = run_passes(ir.Program([program.functions[i] for (i, _) in missed], names))
+    for ((i, key), func) in zip(missed, optimized.functions):
+        program.functions[i] = func
+        memo.put_entry(key, {"function": flatten(func, names)})
+    memo.evict()
+    return program
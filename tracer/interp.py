@@ -0,0 +1,457 @@
+"""
+Bril Interpreter
+Cynthia Shao and Jonathan Brown
+
+Runs an ir.Program in process, so trace.py doesn't need to start brili. It
+can record a trace like `brili -t`: the instructions main executes, labels
+included and callee bodies left out, as ir.Instr copies, stopping before the
+first jump back to a label it has already recorded. Recording also stops
+after budget instructions. With inline, the instructions of each call main
+makes are recorded too, up to inline of them per call, with their call depth
+in depths so trace.py can splice them in place of the call. With retrace
+it records through jumps back into the trace, so a loop's iterations are
+all recorded, until the budget runs out. Once the trace is done the rest of the program
+isn't needed for tracing, so by default it stops running too.
+
+It counts dynamic instructions like `brili -p` (every executed instruction
+but labels, callees included) and taken back-edges, jumps to a label at or
+before the jump, per (function, label). With profile it also counts how
+often each block ran, per (function, label), and each edge between blocks
+was taken, per (function, source label, target label), the entry block
+being labelled "". profiles.py collects these over many runs.
+
+  python interp.py [-p] [-t] args... < prog.json
+
+Values are python ints (wrapped to 64 bits like brili), bools, floats, one
+character strings and Pointers. Errors raise BrilError, which the command
+line reports with exit status 2 like brili.
+"""
+
+import json
+import math
+import sys
+
+import ir
+import lvn
+import wire
+
+class BrilError(Exception):
+    pass
+
+class Pointer:
+    __slots__ = ("base", "offset")
+
+    def __init__(self, base, offset):
+        self.base = base
+        self.offset = offset
+
+    def __eq__(self, other):
+        return isinstance(other, Pointer) and self.base == other.base and self.offset == other.offset
+
+    def __hash__(self):
+        return hash((self.base, self.offset))
+
+    def __repr__(self):
+        return f"Pointer({self.base}, {self.offset})"
+
+def format_value(v):
+    """a value the way brili prints it"""
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, float):
+        if v != v:
+            return "NaN"
+        if v in (float("inf"), float("-inf")):
+            return "Infinity" if v > 0 else "-Infinity"
+        return f"{v:.17f}"
+    if isinstance(v, Pointer):
+        return repr(v)
+    return str(v)
+
+def parse_arg(text, typ):
+    if typ == "int":
+        try:
+            return int(text)
+        except ValueError:
+            raise BrilError(f"expected an int argument, got {text!r}")
+    if typ == "bool":
+        if text not in ("true", "false"):
+            raise BrilError(f"expected a bool argument, got {text!r}")
+        return text == "true"
+    if typ == "float":
+        return float(text)
+    if typ == "char":
+        if len(text) != 1:
+            raise BrilError(f"expected a char argument, got {text!r}")
+        return text
+    raise BrilError(f"can't pass an argument of type {typ}")
+
+def const_value(instr):
+    if instr.type == "float":
+        return float(instr.value)
+    return instr.value
+
+def fdiv(a, b):
+    # js division, which doesn't raise
+    if b == 0:
+        if a == 0 or a != a:
+            return float("nan")
+        return math.copysign(float("inf"), a) * math.copysign(1.0, b)
+    return a / b
+
+BINARY = dict(lvn.FOLD_OPS)
+del BINARY[ir.NOT]
+BINARY.update({
+    ir.OPCODES["fadd"]: lambda a, b: a + b,
+    ir.OPCODES["fsub"]: lambda a, b: a - b,
+    ir.OPCODES["fmul"]: lambda a, b: a * b,
+    ir.OPCODES["fdiv"]: fdiv,
+    ir.OPCODES["feq"]: lambda a, b: a == b,
+    ir.OPCODES["flt"]: lambda a, b: a < b,
+    ir.OPCODES["fgt"]: lambda a, b: a > b,
+    ir.OPCODES["fle"]: lambda a, b: a <= b,
+    ir.OPCODES["fge"]: lambda a, b: a >= b,
+    ir.OPCODES["ceq"]: lambda a, b: a == b,
+    ir.OPCODES["clt"]: lambda a, b: a < b,
+    ir.OPCODES["cgt"]: lambda a, b: a > b,
+    ir.OPCODES["cle"]: lambda a, b: a <= b,
+    ir.OPCODES["cge"]: lambda a, b: a >= b,
+})
+UNARY = {
+    ir.NOT: lambda a: not a,
+    ir.OPCODES["char2int"]: ord,
+    ir.OPCODES["int2char"]: chr,
+}
+LOAD = ir.OPCODES["load"]
+PTRADD = ir.OPCODES["ptradd"]
+NOP = ir.OPCODES["nop"]
+
+class Function:
+    """an ir.Function with its label positions, for running"""
+    __slots__ = ("func", "instrs", "labels", "block_labels")
+
+    def __init__(self, func):
+        self.func = func
+        self.instrs = func.instrs
+        self.labels = {instr.labels[0]: i for (i, instr) in enumerate(func.instrs) if instr.op == ir.LABEL}
+        # label of the block every instruction is in, "" for the entry block
+        self.block_labels = []
+        label = ""
+        for instr in func.instrs:
+            if instr.op == ir.LABEL:
+                label = instr.labels[0]
+            self.block_labels.append(label)
+
+class Frame:
+    __slots__ = ("fn", "pc", "env", "dest", "speculating")
+
+    def __init__(self, fn, env, dest):
+        self.fn = fn
+        self.pc = 0
+        self.env = env
+        self.dest = dest
+        # saved envs of the open speculate regions, innermost last
+        self.speculating = []
+
+class Interpreter:
+    """
+    out gets the program's output, None drops it. With trace, the
+    instructions main executes are recorded into self.trace; run_to_end=False
+    stops the program once the trace is done.
+    """
+
+    def __init__(self, program, out=sys.stdout, trace=False, budget=None, run_to_end=True, inline=0, retrace=False,
+                 profile=False):
+        self.program = program
+        self.out = out
+        self.functions = {func.name: Function(func) for func in program.functions}
+        self.tracing = trace and (budget is None or budget > 0)
+        self.budget = budget
+        self.run_to_end = run_to_end
+        # what run records, and the call depth of each instruction, 0 for main's own
+        self.trace = []
+        self.depths = []
+        self.recorded = 0
+        self.inline = inline
+        # instructions left to record for the call main is in
+        self.call_left = 0
+        self.traced_labels = set()
+        # keep recording through jumps back into the trace, until the budget
+        self.retrace = retrace
+        self.dyn_count = 0
+        self.back_edges = {}
+        self.profiling = profile
+        self.block_counts = {}
+        self.edge_counts = {}
+        self.memory = {}
+        self.next_alloc = 0
+        # the BrilError a trace run stopped on, if any
+        self.error = None
+
+    def run(self, args=()):
+        """run main on args (strings), returns what main returned. The trace goes into self.trace"""
+        steps = self.steps(args)
+        while True:
+            try:
+                instr, depth = next(steps)
+            except StopIteration as stop:
+                return stop.value
+            self.trace.append(instr)
+            self.depths.append(depth)
+
+    def steps(self, args=()):
+        """
+        run main on args, yielding (instr, call depth) for every instruction
+        as it is recorded, so the trace needn't be held. Returns what main
+        returned, or None if the run stopped with the trace.
+        """
+        main = self.functions.get("main")
+        if main is None:
+            raise BrilError("no main function")
+        params = main.func.args
+        if len(args) != len(params):
+            raise BrilError(f"main takes {len(params)} arguments, got {len(args)}")
+        env = {var: parse_arg(text, typ) for ((var, typ), text) in zip(params, args)}
+        return (yield from self.execute(Frame(main, env, None)))
+
+    def stream(self, args=()):
+        """steps, with a BrilError ending the trace where it happened, like brili dying, and kept in error"""
+        try:
+            yield from self.steps(args)
+        except BrilError as e:
+            self.error = e
+
+    def record(self, instr, depth):
+        self.recorded += 1
+        if depth:
+            self.call_left -= 1
+        if self.budget is not None and self.recorded >= self.budget:
+            self.tracing = False
+        return (instr.copy(), depth)
+
+    def get(self, env, var):
+        try:
+            return env[var]
+        except KeyError:
+            raise BrilError(f"undefined variable {self.program.names.name(var)}")
+
+    def execute(self, frame):
+        stack = [frame]
+        fn = frame.fn
+        instrs = fn.instrs
+        env = frame.env
+        pc = 0
+        get = self.get
+        profiling = self.profiling
+        # whether control just jumped, so a label isn't reached by falling through
+        jumped = False
+        if profiling:
+            self.count_block(fn, "")
+        while True:
+            if pc >= len(instrs):
+                instr = None
+                op = ir.RET
+            else:
+                instr = instrs[pc]
+                op = instr.op
+            depth = len(stack) - 1
+            in_main = depth == 0
+            recording = self.tracing and (in_main or self.call_left > 0)
+            if op == ir.LABEL:
+                if profiling:
+                    label = instr.labels[0]
+                    if not jumped and pc > 0:
+                        self.count_edge(fn, fn.block_labels[pc - 1], label)
+                    self.count_block(fn, label)
+                    jumped = False
+                if recording:
+                    if in_main:
+                        self.traced_labels.add(instr.labels[0])
+                    yield self.record(instr, depth)
+                    if not self.tracing and not self.run_to_end:
+                        return None
+                pc += 1
+                continue
+            if instr is not None:
+                self.dyn_count += 1
+
+            if op == ir.JMP or op == ir.BR:
+                if op == ir.JMP:
+                    label = instr.labels[0]
+                else:
+                    cond = get(env, instr.args[0])
+                    label = instr.labels[0] if cond else instr.labels[1]
+                target = fn.labels.get(label)
+                if target is None:
+                    raise BrilError(f"no label {label} in {fn.func.name}")
+                if target <= pc:
+                    key = (fn.func.name, label)
+                    self.back_edges[key] = self.back_edges.get(key, 0) + 1
+                if profiling:
+                    self.count_edge(fn, fn.block_labels[pc], label)
+                    jumped = True
+                if recording:
+                    if in_main and label in self.traced_labels and not self.retrace:
+                        # brili -t stops before jumping back into the trace
+                        self.tracing = False
+                    else:
+                        yield self.record(instr, depth)
+                    if not self.tracing and not self.run_to_end:
+                        return None
+                pc = target
+                continue
+
+            if recording:
+                if instr is None:
+                    # a callee running off its end, so its body ends with a ret
+                    if not in_main:
+                        yield self.record(ir.Instr(ir.RET), depth)
+                else:
+                    yield self.record(instr, depth)
+                if not self.tracing and not self.run_to_end:
+                    return None
+                if in_main and op == ir.CALL:
+                    self.call_left = self.inline
+            pc += 1
+
+            if op in BINARY:
+                a = get(env, instr.args[0])
+                b = get(env, instr.args[1])
+                if op == ir.DIV and b == 0:
+                    raise BrilError("division by zero")
+                env[instr.dest] = BINARY[op](a, b)
+            elif op == ir.CONST:
+                env[instr.dest] = const_value(instr)
+            elif op == ir.ID:
+                env[instr.dest] = get(env, instr.args[0])
+            elif op in UNARY:
+                try:
+                    env[instr.dest] = UNARY[op](get(env, instr.args[0]))
+                except (ValueError, OverflowError, TypeError) as e:
+                    raise BrilError(str(e))
+            elif op == ir.PRINT:
+                if self.out is not None:
+                    self.out.write(" ".join(format_value(get(env, a)) for a in instr.args) + "\n")
+            elif op == ir.CALL:
+                callee = self.functions.get(instr.funcs[0])
+                if callee is None:
+                    raise BrilError(f"no function {instr.funcs[0]}")
+                params = callee.func.args
+                if len(params) != len(instr.args):
+                    raise BrilError(f"{instr.funcs[0]} takes {len(params)} arguments, got {len(instr.args)}")
+                new_env = {var: get(env, a) for ((var, _), a) in zip(params, instr.args)}
+                frame.pc = pc
+                frame = Frame(callee, new_env, instr.dest)
+                stack.append(frame)
+                fn = callee
+                instrs = fn.instrs
+                env = new_env
+                pc = 0
+                if profiling:
+                    self.count_block(fn, "")
+                    jumped = True
+            elif op == ir.RET:
+                value = get(env, instr.args[0]) if instr is not None and instr.args else None
+                dest = frame.dest
+                stack.pop()
+                if not stack:
+                    return value
+                frame = stack[-1]
+                fn = frame.fn
+                instrs = fn.instrs
+                env = frame.env
+                pc = frame.pc
+                jumped = False
+                if dest is not None:
+                    env[dest] = value
+            elif op == ir.SPECULATE:
+                frame.speculating.append(dict(env))
+            elif op == ir.COMMIT:
+                if not frame.speculating:
+                    raise BrilError("commit outside of speculation")
+                frame.speculating.pop()
+            elif op == ir.GUARD:
+                if not get(env, instr.args[0]):
+                    if not frame.speculating:
+                        raise BrilError("guard outside of speculation")
+                    env = frame.env = frame.speculating.pop()
+                    target = fn.labels.get(instr.labels[0])
+                    if target is None:
+                        raise BrilError(f"no label {instr.labels[0]} in {fn.func.name}")
+                    pc = target
+                    # a rollback, not an edge of the cfg
+                    jumped = True
+            elif op == ir.ALLOC:
+                size = get(env, instr.args[0])
+                if size <= 0:
+                    raise BrilError(f"cannot allocate {size} entries")
+                self.memory[self.next_alloc] = [None] * size
+                env[instr.dest] = Pointer(self.next_alloc, 0)
+                self.next_alloc += 1
+            elif op == ir.FREE:
+                ptr = get(env, instr.args[0])
+                if ptr.offset != 0 or self.memory.pop(ptr.base, None) is None:
+                    raise BrilError(f"bad free of {ptr}")
+            elif op == ir.STORE:
+                ptr = get(env, instr.args[0])
+                self.cell(ptr)[ptr.offset] = get(env, instr.args[1])
+            elif op == LOAD:
+                ptr = get(env, instr.args[0])
+                value = self.cell(ptr)[ptr.offset]
+                if value is None:
+                    raise BrilError(f"load of uninitialized memory at {ptr}")
+                env[instr.dest] = value
+            elif op == PTRADD:
+                ptr = get(env, instr.args[0])
+                env[instr.dest] = Pointer(ptr.base, ptr.offset + get(env, instr.args[1]))
+            elif op == NOP:
+                pass
+            else:
+                raise BrilError(f"unknown op {ir.OP_NAMES[op]}")
+
+    def count_block(self, fn, label):
+        key = (fn.func.name, label)
+        self.block_counts[key] = self.block_counts.get(key, 0) + 1
+
+    def count_edge(self, fn, source, target):
+        key = (fn.func.name, source, target)
+        self.edge_counts[key] = self.edge_counts.get(key, 0) + 1
+
+    def cell(self, ptr):
+        """the allocation ptr points into, checking it is in bounds"""
+        mem = self.memory.get(ptr.base)
+        if mem is None or not 0 <= ptr.offset < len(mem):
+            raise BrilError(f"access out of bounds at {ptr}")
+        return mem
+
+    def leaked(self):
+        return bool(self.memory)
+
+def tracer(program, budget=None, inline=0, retrace=False):
+    """
+    an Interpreter that records what brili -t would print with the output
+    dropped and stops with the trace, for stream
+    """
+    return Interpreter(program, out=None, trace=True, budget=budget, run_to_end=False, inline=inline, retrace=retrace)
+
+def main():
+    argv = sys.argv[1:]
+    profile = "-p" in argv
+    tracing = "-t" in argv
+    args = [a for a in argv if a not in ("-p", "-t")]
+    program = wire.read_program()
+    interp = Interpreter(program, trace=tracing)
+    try:
+        interp.run(args)
+    except BrilError as e:
+        sys.stdout.flush()
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(2)
+    if tracing:
+        for instr in interp.trace:
+            print(json.dumps(ir.instr_to_json(instr, program.names)))
+    if profile:
+        print(f"total_dyn_inst: {interp.dyn_count}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+Compact IR
+Cynthia Shao and Jonathan Brown
+
+A small internal form of a Bril program shared by the tracer, LVN and DCE.
+Opcodes are ints, variable names are interned to ints per program, and
+instructions are __slots__ objects, so passes compare ints instead of probing
+json dicts. Build it once with from_json and lower it back with to_json only
+when the program is written out.
+"""
+
+import sys
+
+# ==== OPCODES ====
+
+OP_NAMES = [
+    "label", "const", "id",
+    "add", "sub", "mul", "div",
+    "eq", "lt", "gt", "le", "ge",
+    "not", "and", "or",
+    "fadd", "fsub", "fmul", "fdiv", "feq", "flt", "fgt", "fle", "fge",
+    "ceq", "clt", "cgt", "cle", "cge", "char2int", "int2char",
+    "ptradd", "alloc", "free", "store", "load",
+    "jmp", "br", "ret", "call", "print", "nop",
+    "speculate", "commit", "guard",
+]
+OPCODES = {name: i for (i, name) in enumerate(OP_NAMES)}
+
+def opcode(name):
+    """Opcode for name, registering ops we don't know about so they round trip"""
+    code = OPCODES.get(name)
+    if code is None:
+        code = len(OP_NAMES)
+        OP_NAMES.append(name)
+        OPCODES[name] = code
+    return code
+
+LABEL = OPCODES["label"]
+CONST = OPCODES["const"]
+ID = OPCODES["id"]
+JMP = OPCODES["jmp"]
+BR = OPCODES["br"]
+RET = OPCODES["ret"]
+CALL = OPCODES["call"]
+ADD = OPCODES["add"]
+SUB = OPCODES["sub"]
+MUL = OPCODES["mul"]
+DIV = OPCODES["div"]
+EQ = OPCODES["eq"]
+LT = OPCODES["lt"]
+GT = OPCODES["gt"]
+LE = OPCODES["le"]
+GE = OPCODES["ge"]
+NOT = OPCODES["not"]
+AND = OPCODES["and"]
+OR = OPCODES["or"]
+ALLOC = OPCODES["alloc"]
+FREE = OPCODES["free"]
+STORE = OPCODES["store"]
+PRINT = OPCODES["print"]
+SPECULATE = OPCODES["speculate"]
+COMMIT = OPCODES["commit"]
+GUARD = OPCODES["guard"]
+
+# ops whose result only depends on their operands
+PURE = frozenset(OPCODES[op] for op in [
+    "const", "id", "add", "sub", "mul", "div", "eq", "lt", "gt", "le", "ge",
+    "not", "and", "or", "fadd", "fsub", "fmul", "fdiv", "feq", "flt", "fgt",
+    "fle", "fge", "ceq", "clt", "cgt", "cle", "cge", "char2int", "int2char", "ptradd",
+])
+COMMUTATIVE = frozenset(OPCODES[op] for op in ["add", "mul", "and", "or", "eq", "fadd", "fmul", "feq", "ceq"])
+TERMINATORS = frozenset([JMP, BR, RET])
+
+# ==== VARIABLES ====
+
+class Names:
+    """Interns variable names to small ints"""
+    __slots__ = ("ids", "names")
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def intern(self, name):
+        idx = self.ids.get(name)
+        if idx is None:
+            idx = len(self.names)
+            self.ids[name] = idx
+            self.names.append(name)
+        return idx
+
+    def name(self, idx):
+        return self.names[idx]
+
+    def fresh(self, base):
+        """Intern a new name starting with base that isn't used yet"""
+        i = 0
+        while f"{base}.{i}" in self.ids:
+            i += 1
+        return self.intern(f"{base}.{i}")
+
+    def __len__(self):
+        return len(self.names)
+
+# ==== INSTRUCTIONS ====
+
+class Instr:
+    """
+    One instruction or label. dest is a var id or None, args is a tuple of var
+    ids, a label instruction keeps its name in labels[0].
+    """
+    __slots__ = ("op", "dest", "type", "args", "funcs", "labels", "value")
+
+    def __init__(self, op, dest=None, type=None, args=(), funcs=(), labels=(), value=None):
+        self.op = op
+        self.dest = dest
+        self.type = type
+        self.args = args
+        self.funcs = funcs
+        self.labels = labels
+        self.value = value
+
+    @staticmethod
+    def label(name):
+        return Instr(LABEL, labels=(name,))
+
+    def copy(self):
+        return Instr(self.op, self.dest, self.type, self.args, self.funcs, self.labels, self.value)
+
+    def __repr__(self):
+        return f"Instr({OP_NAMES[self.op]}, dest={self.dest}, args={self.args}, labels={self.labels}, value={self.value})"
+
+class Function:
+    __slots__ = ("name", "args", "type", "instrs")
+
+    def __init__(self, name, args, type, instrs):
+        self.name = name
+        self.args = args  # list of (var id, type)
+        self.type = type
+        self.instrs = instrs
+
+class Program:
+    __slots__ = ("functions", "names")
+
+    def __init__(self, functions, names):
+        self.functions = functions
+        self.names = names
+
+    def function(self, name):
+        for func in self.functions:
+            if func.name == name:
+                return func
+        return None
+
+# ==== JSON CONVERSION ====
+
+def intern_type(typ):
+    if isinstance(typ, str):
+        return sys.intern(typ)
+    return typ
+
+def instr_from_json(instr, names):
+    if "label" in instr:
+        return Instr.label(sys.intern(instr["label"]))
+    intern = names.intern
+    dest = instr.get("dest")
+    return Instr(
+        opcode(instr["op"]),
+        intern(dest) if dest is not None else None,
+        intern_type(instr.get("type")),
+        tuple(intern(a) for a in instr.get("args", ())),
+        tuple(instr.get("funcs", ())),
+        tuple(sys.intern(l) for l in instr.get("labels", ())),
+        instr.get("value"),
+    )
+
+def instr_to_json(instr, names):
+    if instr.op == LABEL:
+        return {"label": instr.labels[0]}
+    out = {}
+    if instr.dest is not None:
+        out["dest"] = names.names[instr.dest]
+    if instr.type is not None:
+        out["type"] = instr.type
+    out["op"] = OP_NAMES[instr.op]
+    if instr.args:
+        out["args"] = [names.names[a] for a in instr.args]
+    if instr.funcs:
+        out["funcs"] = list(instr.funcs)
+    if instr.labels:
+        out["labels"] = list(instr.labels)
+    if instr.op == CONST:
+        out["value"] = instr.value
+    return out
+
+def function_from_json(func, names):
+    args = [(names.intern(a["name"]), intern_type(a["type"])) for a in func.get("args", ())]
+    instrs = [instr_from_json(instr, names) for instr in func.get("instrs", ())]
+    return Function(func["name"], args, func.get("type"), instrs)
+
+def function_to_json(func, names):
+    out = {"name": func.name}
+    if func.args:
+        out["args"] = [{"name": names.names[a], "type": t} for (a, t) in func.args]
+    if func.type is not None:
+        out["type"] = func.type
+    out["instrs"] = [instr_to_json(instr, names) for instr in func.instrs]
+    return out
+
+def from_json(program):
+    names = Names()
+    return Program([function_from_json(func, names) for func in program["functions"]], names)
+
+def to_json(program):
+    return {"functions": [function_to_json(func, program.names) for func in program.functions]}
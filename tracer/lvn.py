@@ -1,14 +1,31 @@
 """
-Control Flow Graph!
+Value Numbering
 Jonathan Brown and Cynthia Shao
 
-This script takes in a Bril json file and outputs the 
-corresponding control flow graph in a edge list format.
+This script takes in a Bril json file and outputs it with redundant
+computations replaced by copies and constants folded, numbering values one
+basic block at a time. With -g values are numbered across blocks down the
+dominator tree:
+
+  python lvn.py < prog.json
+  python lvn.py -g < prog.json
+
+-j N (or --jobs N) spreads the functions over N worker processes, and
+--stream optimizes and writes one function at a time so memory is bounded by
+the biggest function rather than the whole module.
 """
 from enum import Enum
 import json
 import sys
 
+import cache
+import cfg
+import incremental
+import ir
+import parallel
+import stats
+import wire
+
 class Table_Occ(Enum):
      IN_TABLE = 1
      NOT_IN_TABLE = 2
@@ -17,35 +34,31 @@ class Table_Occ(Enum):
      DONT_USE = 5
 
 
-# with open(sys.argv[1], 'r') as file:
-#     instrs = json.load(file)
-instrs = json.load(sys.stdin)
-
-commutative_instr = ["call", "add", "mul", "and", "or", "eq", "neq"]
 #Make var a sort of enum, make var a str, and make idx a num
 class LVN_Value:
-    def __init__(self, instr, vars): #Instr = string, var1 is the variable index, var2 is the var index
+    """
+    Canonical, hashable form of a value: the op plus the value numbers of its
+    operands (sorted for commutative ops). Constants use the type and value as
+    operands so `const 1` of int and `const true` of bool never collide.
+    """
+    __slots__ = ("instr", "vars", "_hash")
+
+    def __init__(self, instr, vars): #Instr = ir opcode, vars = tuple of value numbers (or const type/value)
         self.instr = instr 
-        if instr in commutative_instr:
-            sorted_vars = tuple(sorted(vars))
-            self.vars = sorted_vars
+        if instr in ir.COMMUTATIVE:
+            self.vars = tuple(sorted(vars))
         else:
-            self.vars = vars
-    #TODO: Watch out, subtraction needs the order kept, only for commutative properties, do some sort of checking for add, mul, etc, otherwise do nothing
-        
-    #TODO: Watch out, const values can be confused for actual vals
+            self.vars = tuple(vars)
+        self._hash = hash((self.instr, self.vars))
+
     def __eq__(self, other):
-        if self.instr == other.instr:
-            for (i, var) in enumerate(self.vars):
-                for (j, var2) in enumerate(other.vars):
-                    if i == j:
-                        if type(var) is not type(var2) or var != var2:
-                            return False 
-            return True
-        else:
-            return False
+        return self.instr == other.instr and self.vars == other.vars
+
+    def __hash__(self):
+        return self._hash
+
     def __str__(self):
-        return f"(Instr = {self.instr}, Value = ({self.vars}))"
+        return f"(Instr = {ir.OP_NAMES[self.instr]}, Value = ({self.vars}))"
     __repr__ = __str__
 
 class LVN_Table:
@@ -57,501 +70,367 @@ class LVN_Table:
         return f"(Idx = {self.idx}, Value = {self.value}, Var = {self.var})"
     __repr__ = __str__
 
-
-def split_func_calls(funcs): #get funcy
-    res = ""
-    for (i,func) in enumerate(funcs):
-        if i < (len(funcs) - 1):
-            res += func + ", "
-        else:
-            res += func
-    return res
-
-# GLOBAL INSTANTIATIONS
-
-# basic block arrays
-blocks = []
-block = []
-
-# function headers to basic blocks that are headers
-func_headers = {}
-
-# function to variables mappings
-func_vars = {}
-func_defs = {}
-
-# function to basic blocks under that function mappings
-func_blocks = {}  # func_blocks[func_name] = [list of blocks in that function]
-block_ref_count = {}
-label_to_block = {}
-
-# function to cfg mapping, just constructing cfg out of blocks yields a forest
-# want to label the forest by function
-func_cfg = {}
-
-# function to dominators mapping
-func_dom = {}
-# function to predecessors mapping
-func_preds = {}
-
-# function to sorted dominator set mapping
-func_sorted_dom = {}
-
-# function to dominance frontier mapping
-func_DF = {}
-
-# BASIC BLOCK DEFS
-
-class Block:
-    def __init__(self, idx, instrs, is_func_header):
-        self.idx = idx
-        self.instrs = instrs
-        self.edges = []
-        self.is_header = is_func_header
-
-    def label(self):
-        if self.instrs and "labels" in self.instrs[0]:
-            return self.instrs[0]["labels"]
+ignore_ops = frozenset([ir.LABEL, ir.JMP, ir.SPECULATE, ir.COMMIT])
+MISSING = object()
+
+def type_key(typ):
+    if isinstance(typ, dict):
+        return json.dumps(typ, sort_keys=True)
+    return typ
+
+def new_counts():
+    """
+    lvn counters: ids that were already in place, expressions found in the
+    table, copies aliased and instructions folded
+    """
+    return {"lvn_hits": 0, "lvn_copies": 0, "lvn_folded": 0, "lvn_redundant": 0}
+
+# ==== CONSTANT FOLDING ====
+
+def wrap64(v):
+    """Bril ints are 64-bit two's complement"""
+    v &= (1 << 64) - 1
+    return v - (1 << 64) if v >> 63 else v
+
+def int_div(a, b):
+    # brili divides BigInts, which truncates toward zero
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+FOLD_OPS = {
+    ir.ADD: lambda a, b: wrap64(a + b),
+    ir.SUB: lambda a, b: wrap64(a - b),
+    ir.MUL: lambda a, b: wrap64(a * b),
+    ir.DIV: lambda a, b: wrap64(int_div(a, b)),
+    ir.EQ: lambda a, b: a == b,
+    ir.LT: lambda a, b: a < b,
+    ir.GT: lambda a, b: a > b,
+    ir.LE: lambda a, b: a <= b,
+    ir.GE: lambda a, b: a >= b,
+    ir.AND: lambda a, b: a and b,
+    ir.OR: lambda a, b: a or b,
+    ir.NOT: lambda a: not a,
+}
+
+def simplify(op, arg_idx, num2const):
+    """
+    Fold op over the value numbers in arg_idx, num2const giving the constant
+    ones. Returns ("const", value) when the result is a known constant,
+    ("id", k) when it is just the k-th operand, or None when nothing is known.
+    Division by zero is left for the interpreter to report.
+    """
+    if op not in FOLD_OPS:
         return None
-    
-    def last(self):
-        if self.instrs:
-            return self.instrs[-1]
+    consts = [num2const.get(idx) for idx in arg_idx]
+    known = [idx in num2const for idx in arg_idx]
+    if all(known):
+        if op == ir.DIV and consts[1] == 0:
+            return None
+        return ("const", FOLD_OPS[op](*consts))
+    if op == ir.NOT:
         return None
 
-    def add_edge(self, target):
-        if target not in self.edges:
-            self.edges.append(target)
-    
-    def __str__(self):
-        return f"Block(idx={self.idx}, label={Block.label(self)}, edges = {self.edges} )"          
-    __repr__ = __str__
-
-# CONSTRUCTING BASIC BLOCKS
-
-def get_block_name(self,lbl):
-    if self: 
-        first = self[0]
-        if "label" in first:
-            return first["label"]
-        elif "dest" in first:
-            return first["dest"]
-        elif "funcs" in first:
-            return split_func_calls(first["funcs"])
-        else:
-            return first["op"]
-    else:
-        return lbl
-
-def name_in_blocks(name):
-    if name == "": 
-        return False
-    for b in blocks: 
-        if b.idx == name:
-            return True 
-    return False
-
-# ==== INSTANTIATING GLOBAL BASIC BLOCKS ====
-
-for func in instrs["functions"]:
-    if "instrs" in func:
-        for (i, instr) in enumerate(func["instrs"]):
-            if i == 0:
-                is_func_header = True
-            if "label" in instr:
-                # Save the previous block if it exists
-                if block:
-                    name = get_block_name(block, "")
-                    b0 = Block(name, block, is_func_header)
-                    if is_func_header == True:
-                        b0 = Block("f" + func["name"], block, is_func_header)
-                    is_func_header = False
-                    blocks.append(b0)
-                    block = []
-                # Start new block with the label
-                block.append(instr)
-            elif "op" in instr:
-                if instr["op"] == "br" or instr["op"] == "jmp" or instr["op"] == "ret":
-                    block.append(instr)
-                    name = get_block_name(block, "")
-                    b1 = Block(name, block, is_func_header)
-                    if is_func_header == True:
-                        b1 = Block("f" + func["name"], block, is_func_header)
-                    is_func_header = False
-                    blocks.append(b1)
-                    block = []
-                else:
-                    block.append(instr)
-        # Handle remaining instructions
-        if block:
-            name = get_block_name(block, "")
-            b2 = Block(name, block, is_func_header)
-            if is_func_header == True:
-                b2 = Block("f" + func["name"], block, is_func_header)
-            is_func_header = False
-            blocks.append(b2)
-            block = []
-
-# Clean up empty blocks
-cleanup_arr = []
-for (i, block) in enumerate(blocks):
-    if block.idx != "":
-        cleanup_arr.append(block)
-blocks = cleanup_arr
-
-# FUNCTION PROCESSING
-
-# Group blocks by function
-for block in blocks:
-    if block.is_header:
-        current_func = block.idx
-        func_headers[current_func] = block
-        func_blocks[current_func] = [block]  # Include the header block itself
-    else:
-        if current_func:
-            func_blocks[current_func].append(block)
-
-# block to function lookup
-block_map = {block.idx: block for block in blocks}  # Global block map
-func_block_maps = {}  # Per-function block maps
-
-for func_name, func_block_list in func_blocks.items():
-    func_block_maps[func_name] = {block.idx: block for block in func_block_list}
-
-def get_block(block_idx, func_name=None):
-    if func_name and func_name in func_block_maps:
-        return func_block_maps[func_name].get(block_idx)
-    else:
-        return block_map.get(block_idx)
-
-# LABEL MAPPING POST BLOCK PROCESSING
-
-for func_name, func_blocks_list in func_blocks.items():
-    for block in func_blocks_list:
-        # Check if this block has a label
-        if block.instrs and "label" in block.instrs[0]:
-            label_name = block.instrs[0]["label"]
-            label_to_block[label_name] = block.idx
-
-# VARIABLE PROCESSING
-
-# for each function create the variables
-for func_name, blocks in func_blocks.items():
-    variables = set()
-    func_defs[func_name] = {}
-    
-    # First, add function arguments as variables
-    # Find the original function definition to get its arguments
-    for orig_func in instrs["functions"]:
-        if "f" + orig_func["name"] == func_name or orig_func["name"] == func_name:
-            if "args" in orig_func:
-                for arg in orig_func["args"]:
-                    arg_name = arg["name"]
-                    arg_type = arg["type"]
-                    variables.add((arg_name, json.dumps(arg_type, sort_keys=True)))
-                    # Function arguments are "defined" at the entry block
-                    func_defs[func_name][arg_name] = [blocks[0].idx]
-            break
-    
-    # Then process instructions in blocks
-    for block in blocks:
-        for instr in block.instrs:
-            if "dest" in instr and "type" in instr:
-                var_name = instr["dest"]
-                var_type = instr["type"]
-                variables.add((var_name, json.dumps(var_type, sort_keys=True)))
-                # Initialize the list if this is the first time we see this variable
-                if var_name not in func_defs[func_name]:
-                    func_defs[func_name][var_name] = []
-                # Add the block index (not the block object) to the list
-                func_defs[func_name][var_name].append(block.idx)
-    
-    func_vars[func_name] = variables
-
-# CFG PROCESSING
-
-def probe_next_in_func(block_idx, func_blocks_list):
-    """Find the next block within a specific function"""
-    found = False
-    for (i, b) in enumerate(func_blocks_list):
-        if found and b.idx != block_idx:
-            return b.idx
-        if b.idx == block_idx:
-            found = True
+    a, b = arg_idx
+    if a == b:
+        if op == ir.SUB:
+            return ("const", 0)
+        if op in (ir.EQ, ir.LE, ir.GE):
+            return ("const", True)
+        if op in (ir.LT, ir.GT):
+            return ("const", False)
+        if op in (ir.AND, ir.OR):
+            return ("id", 0)
+    # identities with one constant operand, k is the other operand
+    for (c, k) in ((1, 0), (0, 1)):
+        if not known[c]:
+            continue
+        value = consts[c]
+        if op == ir.ADD and value == 0:
+            return ("id", k)
+        if op == ir.MUL and value == 1:
+            return ("id", k)
+        if op == ir.MUL and value == 0:
+            return ("const", 0)
+        if op == ir.AND:
+            return ("id", k) if value else ("const", False)
+        if op == ir.OR:
+            return ("const", True) if value else ("id", k)
+        if c == 1 and op == ir.SUB and value == 0:
+            return ("id", k)
+        if c == 1 and op == ir.DIV and value == 1:
+            return ("id", k)
     return None
 
-def build_cfg_for_func(func_name, func_blocks_list):
-    """Build CFG for a single function"""
-    cfg = {}
-    
-    for block in func_blocks_list:
-        last = block.last()
-        if last is not None and "op" in last:
-            if last["op"] == "jmp":
-                target_label = last["labels"][0]
-                # Map label to actual block name
-                target_block = label_to_block.get(target_label, target_label)
-                cfg[block.idx] = [target_block]
-            elif last["op"] == "br":
-                label1 = last["labels"][0]
-                label2 = last["labels"][1]
-                # Map labels to actual block names
-                target1 = label_to_block.get(label1, label1)
-                target2 = label_to_block.get(label2, label2)
-                cfg[block.idx] = [target1, target2]
-            elif last["op"] == "ret":
-                cfg[block.idx] = []
+# ==== VALUE TABLES ====
+
+class Numbering:
+    """
+    The value tables of one numbering, a block's for lvn or a function's for
+    gvn. Everything a pass run touches is in here or in the instructions, so
+    functions can be numbered anywhere, in any order, on any process.
+    counts is the new_counts dict it adds its counters to.
+    """
+
+    def __init__(self, counts):
+        # var2num[var] = value number currently held by var
+        self.var2num = {}
+        # lvn_list[idx] = LVN_Table row for value number idx, row.var is the variable holding it (None if clobbered)
+        self.lvn_list = []
+        # val2num[LVN_Value] = value number, the hash index into lvn_list
+        self.val2num = {}
+        # home[var] = value number that var is the canonical holder of
+        self.home = {}
+        # num2const[idx] = python value of value number idx when it is a constant
+        self.num2const = {}
+        # writes to var2num, home, val2num and the rows' vars as (table, key, old value),
+        # gvn undoes them back to a mark when it leaves a dominator subtree
+        self.trail = []
+        self.counts = counts
+
+    def new_number(self, value, var):
+        comp = LVN_Table(len(self.lvn_list), value, var)
+        self.lvn_list.append(comp)
+        return comp
+
+    def set_entry(self, table, key, value):
+        self.trail.append((table, key, table.get(key, MISSING)))
+        table[key] = value
+
+    def del_entry(self, table, key):
+        self.trail.append((table, key, table[key]))
+        del table[key]
+
+    def set_holder(self, row, var):
+        self.trail.append((row, None, row.var))
+        row.var = var
+
+    def undo(self, mark):
+        """Roll the tables back to how they were when the trail was mark long"""
+        trail = self.trail
+        while len(trail) > mark:
+            table, key, old = trail.pop()
+            if isinstance(table, LVN_Table):
+                table.var = old
+            elif old is MISSING:
+                del table[key]
             else:
-                # Fall through to next block
-                next_block = probe_next_in_func(block.idx, func_blocks_list)
-                if next_block:
-                    cfg[block.idx] = [next_block]
-                else:
-                    cfg[block.idx] = []
+                table[key] = old
+
+    def arg2num(self, arg):
+        """Value number of arg, numbering it fresh if it was defined outside the block"""
+        if arg not in self.var2num:
+            comp = self.new_number(None, arg)
+            self.set_entry(self.var2num, arg, comp.idx)
+            self.set_entry(self.home, arg, comp.idx)
+        return self.var2num[arg]
+
+    def canonical_var(self, arg):
+        holder = self.lvn_list[self.var2num[arg]].var
+        return holder if holder is not None else arg
+
+    def checkValInTable(self, val):
+        idx = self.val2num.get(val)
+        if idx is None:
+            return (False, None)
+        return (True, self.lvn_list[idx])
+
+    def assign(self, dest, idx):
+        """Point dest at value number idx, dropping whatever dest used to be the home of"""
+        lvn_list = self.lvn_list
+        old = self.home.get(dest)
+        if old is not None:
+            self.del_entry(self.home, dest)
+        if old is not None and old != idx:
+            row = lvn_list[old]
+            self.set_holder(row, None)
+            if row.value is not None and self.val2num.get(row.value) == old:
+                self.del_entry(self.val2num, row.value)
+        self.set_entry(self.var2num, dest, idx)
+        if lvn_list[idx].var is None:
+            self.set_holder(lvn_list[idx], dest)
+            self.set_entry(self.home, dest, idx)
+        elif lvn_list[idx].var == dest:
+            self.set_entry(self.home, dest, idx)
+
+    def createVal(self, instr):
+        """
+        Value number one instruction, rewriting its args to canonical variables.
+        Returns (Table_Occ, LVN_Table row) where IN_TABLE means the value already
+        lives in row.var and REPLACE means instr was an id that now copies the
+        canonical variable.
+        """
+        counts = self.counts
+        lvn_list = self.lvn_list
+        op = instr.op
+        if instr.args:
+            arg_idx = tuple(self.arg2num(arg) for arg in instr.args)
+            instr.args = tuple(self.canonical_var(arg) for arg in instr.args)
         else:
-            # Fall through to next block
-            next_block = probe_next_in_func(block.idx, func_blocks_list)
-            if next_block:
-                cfg[block.idx] = [next_block]
+            arg_idx = ()
+
+        dest = instr.dest
+        if dest is None:
+            return Table_Occ.PRINT_RET, None
+
+        simplified = simplify(op, arg_idx, self.num2const)
+        if simplified is not None:
+            counts["lvn_folded"] += 1
+            kind, result = simplified
+            if kind == "const":
+                op = instr.op = ir.CONST
+                instr.args = ()
+                instr.value = result
             else:
-                cfg[block.idx] = []
-    
-    return cfg
-
-# Create function-based CFGs
-for func_name, func_blocks_list in func_blocks.items():
-    func_cfg[func_name] = build_cfg_for_func(func_name, func_blocks_list)
-
-var2num = {}
-lvn_list = []
-full_lvn_list = []
-accepted_ops = ["const", "add", "print", "call", "mul", "id"]
-# bool_ops = ["le", "lte", "ge", "gte", "eq"]
-one_arg_ops = ["print", "ret"]
-ignore_ops = ["br", "jmp", "speculate", "commit"]
-current_idx = 0
-offset = 0
-free_count = 0
-
-def replace_args(args, arg_repl):
-     new_list = []
-     for arg in args:
-          if arg in arg_repl:
-               new_list.append(arg_repl[arg])
-          else:
-               new_list.append(arg)
-     return new_list
-     
-
-def createVar2Num(varName):
-    global current_idx
-    var2num[varName] = current_idx
-    #  print(varName)
-    current_idx += 1
-
-def getVar2Num(val):
-    if len(val) == 2:
-        val1 = val[0]
-        val2 = val[1]
-        if val1 in var2num:
-            val1 = lvn_list[var2num[val1]]
-        if val2 in var2num:
-            val2 = lvn_list[var2num[val2]]
-        return (val1, val2)
-    else:
-        val = val[0]
-        if val in var2num:
-            val = lvn_list[var2num[val]]
-        return (val, None)
-
-def checkValInTable(val):
-    # print(lvn_list)
-    for lvn in lvn_list:
-        if val == lvn.value:
-            return (True, lvn) 
-    return (False, None)
-
-
-def create_lvn_for_arg(instr, arg):
-    global current_idx
-    var2num[arg] = current_idx
-    val = LVN_Value(instr["op"], (None,))
-    lvn_comp = LVN_Table(current_idx, val, arg)
-    lvn_list.append(lvn_comp)
-    current_idx += 1
-
-def argument_checking(instr):
-    arg_idx = []
-    arg_repl = {}
-    # print(instr)
-    for arg in instr["args"]:
-        if arg in var2num:
-            arg_idx.append(var2num[arg])
-            if var2num[arg] < len(lvn_list): 
-                arg_repl[arg] = lvn_list[var2num[arg]].var
-                # print(f"repl: {arg_repl}")
+                op = instr.op = ir.ID
+                instr.args = (instr.args[result],)
+                arg_idx = (arg_idx[result],)
+
+        if op == ir.ID:
+            idx = arg_idx[0]
+            if lvn_list[idx].var == dest:
+                counts["lvn_redundant"] += 1
+                return Table_Occ.DONT_USE, None
+            # args were already rewritten to the canonical copy, just alias dest
+            self.assign(dest, idx)
+            counts["lvn_copies"] += 1
+            return Table_Occ.REPLACE, None
+
+        if op not in ir.PURE:
+            self.assign(dest, self.new_number(None, None).idx)
+            return Table_Occ.NOT_IN_TABLE, lvn_list[self.var2num[dest]]
+
+        if op == ir.CONST:
+            val = LVN_Value(op, (type_key(instr.type), repr(instr.value)))
         else:
-            create_lvn_for_arg(instr, arg)
-            arg_idx.append(var2num[arg])
-    res = replace_args(instr["args"], arg_repl)
-    return res, arg_idx
-
-     
-#TODO: remove all print(comps) before current_idx +=1 
-
-#Returns (inTable, component)
-def createVal(instr, is_const): #TODO: Optimize this lol
-    #TODO: Maybe make the subroutines a function
-    #TODO: Get rid of code duplication (aka merge const and other instr's inTable route)
-    global current_idx
-    if is_const: #Deal with consts 
-        comp_val = LVN_Value('const', (instr["value"],))
-        inTable, lvn_comp = checkValInTable(comp_val)
+            val = LVN_Value(op, arg_idx)
+        inTable, lvn_comp = self.checkValInTable(val)
         if inTable:
-            var2num[instr["dest"]] = lvn_comp.idx
+            if lvn_comp.var == dest:
+                counts["lvn_redundant"] += 1
+                return Table_Occ.DONT_USE, None
+            self.assign(dest, lvn_comp.idx)
+            counts["lvn_hits"] += 1
             return Table_Occ.IN_TABLE, lvn_comp
-        else:
-            comp = LVN_Table(current_idx, comp_val, instr["dest"])
-            # print(comp)
-            current_idx += 1
-            var2num[instr["dest"]] = comp.idx
-            return Table_Occ.NOT_IN_TABLE, comp 
-    else: #Any functions with arguments
-        if instr["op"] not in one_arg_ops: #TODO: clean up code, both cases are very similar
-            if instr["op"] == "id": #Deal with id cases as they should j be replaced (mostly)
-                # print(instr)
-                arg = instr["args"][0]
-                lvn_comp = None
-                if arg in var2num:
-                    # print(var2num[arg])
-                    # print(lvn_list)
-                    var2num[instr["dest"]] = var2num[arg] 
-                    lvn_comp = lvn_list[var2num[arg]]
-                    if instr["dest"] == lvn_comp.var:
-                        return Table_Occ.DONT_USE, None
-                else:
-                    createVar2Num(arg)
-                    var2num[instr["dest"]] = var2num[arg]
-                    lvn_val = LVN_Value(instr["op"], (instr["args"][0],))
-                    lvn_comp = LVN_Table(current_idx, lvn_val, instr["dest"])
-                    return Table_Occ.NOT_IN_TABLE,lvn_comp
-                # print(lvn_comp)
-                return Table_Occ.REPLACE, lvn_comp
-            elif instr["op"] == "call" or instr["op"] == "guard":
-                new_args, arg_idx = argument_checking(instr)
-                instr["args"] = new_args
-                comp_val = LVN_Value(instr["op"], (*arg_idx,))
-                comp = LVN_Table(current_idx, comp_val, instr["op"])
-                current_idx += 1
-                var2num[instr["op"]] = comp.idx
-                return Table_Occ.NOT_IN_TABLE, comp
-            elif instr["op"] == "store": #TODO: just make some of these functions becuase wowza so much code
-                new_args, arg_idx = argument_checking(instr)
-                instr["args"] = new_args
-                comp_val = LVN_Value(instr["op"], (*arg_idx,))
-                comp = LVN_Table(current_idx, comp_val, instr["op"])
-                current_idx += 1
-                var2num[instr["op"]] = comp.idx
-                return Table_Occ.NOT_IN_TABLE, comp
-            else:
-                new_args, arg_idx = argument_checking(instr)
-                instr["args"] = new_args
-                comp_val = LVN_Value(instr["op"], (*arg_idx,))
-                # print(comp_val)
-                inTable, lvn_comp = checkValInTable(comp_val)
-                if inTable:
-                    if "dest" in instr:
-                        if instr["dest"] == lvn_comp.var:
-                            return Table_Occ.DONT_USE, None
-                        var2num[instr["dest"]] = lvn_comp.idx
-                    elif instr["op"] == "free":
-                         # Need to free it more than once
-                        # print(instr)
-                        free_count +=1 
-                    else:
-                        # print(instr)
-                        var2num[instr["funcs"][0]] = lvn_comp.idx
-                    return Table_Occ.IN_TABLE, lvn_comp
-                else:
-                    new_args, arg_idx = argument_checking(instr)
-                    instr["args"] = new_args
-                    comp_val = LVN_Value(instr["op"], (*arg_idx,))
-                    comp = None
-                    if "dest" in instr:
-                        comp = LVN_Table(current_idx, comp_val, instr["dest"])
-                        var2num[instr["dest"]] = comp.idx
-                    elif "funcs" in instr:
-                        comp = LVN_Table(current_idx, comp_val, instr["funcs"][0])
-                        var2num[instr["funcs"][0]] = comp.idx
-                    elif instr["op"] == "br":
-                        comp = LVN_Table(current_idx, comp_val, instr["op"]) 
-                    elif instr["op"] == "free":
-                        comp = LVN_Table(current_idx, comp_val, instr["op"])
-                    # else: #This is branch ig
-                        # print(instr)
-                        # Warning("HAHAHAHAHA")
-                        # print("MAYDAY SHIP IS SINKING")
-                    current_idx += 1
-                    return Table_Occ.NOT_IN_TABLE, comp
-        else:
-            if instr["op"] == "ret":
-                if "args" not in instr:
-                    return Table_Occ.DONT_USE, None
-            new_args, arg_idx = argument_checking(instr)
-            instr["args"] = new_args
-            comp_val = LVN_Value(instr["op"], (*arg_idx,))
-            comp = LVN_Table(current_idx, comp_val, instr["op"])
-            # print(comp)
-            current_idx += 1
-            var2num[instr["op"]] = comp.idx
-            return Table_Occ.NOT_IN_TABLE, comp
-
-for b in blocks:
-    for (i, instr) in enumerate(b.instrs):
-        lvn_val = None
-        lvn_component = None
-        if "op" in instr and instr["op"] not in ignore_ops:
-            if instr["op"] == 'const':
-                    inTable, lvn_comp = createVal(instr, True)
-                    #TODO: Do something with instr if inTable
-                    if inTable == Table_Occ.IN_TABLE:
-                            instr["op"] = "id"
-                            instr["args"] = [lvn_comp.var]
-                            instr["type"] = "int"
-                            del instr["value"]
-                            if "dest" not in instr:
-                                instr["dest"] = "z"
-                    else:
-                            lvn_list.append(lvn_comp)
-            else: 
-                inTable, lvn_comp = createVal(instr, False)
-                if inTable == Table_Occ.IN_TABLE or inTable == Table_Occ.REPLACE:
-                    instr["op"] = "id"
-                    instr["args"] = [lvn_comp.var]
-                elif inTable == Table_Occ.PRINT_RET:
-                    instr["args"] = [lvn_comp.var]
-                elif inTable == Table_Occ.DONT_USE:
-                     free_count +=1
-                    #  print(f"{instr["op"]} has been thrown in the trash")
-                else:
-                    lvn_list.append(lvn_comp)
-    current_idx = 0
-    var2num = {}
-    lvn_list = []
-    full_lvn_list = []
-
-
-# for l in lvn_list:
-#      print(l)
-# print(var2num)
-# for b in blocks:
-#      for instr in b.instrs:
-#           print(instr)
-
-# def replace_instrs(instr, ):
-# print(instrs)
-     
-# with open(f"{sys.argv[1]}.out","w") as f: #For some reason works although I didn't edit the instrs directly? YIPEEEEEEE
-#     json.dump(instrs, f, indent=4)
-
-json.dump(instrs, sys.stdout, indent=4)
+        comp = self.new_number(val, None)
+        self.assign(dest, comp.idx)
+        self.set_entry(self.val2num, val, comp.idx)
+        if op == ir.CONST:
+            self.num2const[comp.idx] = instr.value
+        return Table_Occ.NOT_IN_TABLE, comp
+
+    def number_block(self, b):
+        """Value number the instructions of one block against the current tables"""
+        for instr in b.instrs:
+            if instr.op not in ignore_ops:
+                inTable, lvn_comp = self.createVal(instr)
+                if inTable == Table_Occ.IN_TABLE:
+                    instr.op = ir.ID
+                    instr.args = (lvn_comp.var,)
+                    instr.value = None
+
+def lvn_block(b, counts):
+    """Value number one block from empty tables"""
+    Numbering(counts).number_block(b)
+
+# ==== GLOBAL VALUE NUMBERING ====
+
+def merge_vars(graph, tree):
+    """
+    block index -> variables whose value at the top of the block can differ
+    from their value at the end of its immediate dominator: the blocks where
+    definitions from different paths meet, the same places SSA would put a phi
+    """
+    def_blocks = {}
+    for b in graph.blocks:
+        for instr in b.instrs:
+            if instr.dest is not None:
+                blocks = def_blocks.setdefault(instr.dest, [])
+                if not blocks or blocks[-1] != b.index:
+                    blocks.append(b.index)
+    merges = {}
+    frontier_memo = {}
+    for (var, blocks) in def_blocks.items():
+        key = tuple(blocks)
+        if key not in frontier_memo:
+            frontier_memo[key] = tree.iterated_frontier(blocks)
+        for m in frontier_memo[key]:
+            merges.setdefault(m, []).append(var)
+    return merges
+
+def gvn_function(graph, counts):
+    """
+    Value number a function down its dominator tree. A block starts from the
+    tables its immediate dominator ended with, minus the variables that merge
+    there, which get fresh numbers. Leaving a subtree undoes its writes.
+    Guard targets are entered with the state rolled back to a speculate, so
+    they start from empty tables as extra roots of the tree.
+
+    Every write goes on the trail once and is undone at most once, so the
+    walk is linear in the instructions plus the merge variables.
+    """
+    tree = cfg.DomTree(graph, graph.guard_targets())
+    merges = merge_vars(graph, tree)
+    numbering = Numbering(counts)
+    marks = []
+    for (i, depth) in tree.preorder():
+        while len(marks) >= depth:
+            numbering.undo(marks.pop())
+        marks.append(len(numbering.trail))
+        for var in merges.get(i, ()):
+            numbering.assign(var, numbering.new_number(None, None).idx)
+        numbering.number_block(graph.blocks[i])
+    numbering.undo(0)
+
+def lvn_function(func, counts, global_numbering=False):
+    """Value number one ir.Function in place, adding to counts"""
+    if global_numbering:
+        # the cfg, dominator tree, rows and trail of a big function keep the
+        # cycle collector rescanning a growing heap, which made gvn superlinear
+        with parallel.no_gc():
+            gvn_function(cfg.CFG(func), counts)
+        return
+    for b in cfg.CFG(func).blocks:
+        lvn_block(b, counts)
+
+def lvn_chunk(program, global_numbering):
+    """parallel.map_functions worker: value number the functions of program, return the counters"""
+    counts = new_counts()
+    for func in program.functions:
+        lvn_function(func, counts, global_numbering)
+    return counts
+
+def lvn(instrs, global_numbering=False):
+    """
+    Run value numbering over every block of an ir.Program, in place. With
+    global_numbering values are numbered across blocks down the dominator tree
+    instead of starting over at each block. Functions are spread over
+    parallel's process pool when it is on and the module is big enough.
+    """
+    if parallel.worth_it(instrs):
+        totals = parallel.map_functions(instrs, lvn_chunk, global_numbering)
+    else:
+        totals = lvn_chunk(instrs, global_numbering)
+    for (name, value) in totals.items():
+        stats.count(name, value)
+    return instrs
+
+def gvn(instrs):
+    """Run dominator-based global value numbering over an ir.Program, in place"""
+    return lvn(instrs, global_numbering=True)
+
+if __name__ == "__main__":
+    global_numbering = "-g" in sys.argv[1:]
+    if "--stream" in sys.argv[1:]:
+        wire.check_stream_argv(sys.argv[1:])
+        wire.stream_program(lambda program: lvn(program, global_numbering), wire.output_format(sys.argv[1:]))
+        sys.exit(0)
+    instrs = wire.read_program()
+    parallel.set_jobs(parallel.jobs_from_argv(sys.argv[1:]))
+    memo_dir = incremental.memo_dir(sys.argv[1:])
+    if memo_dir:
+        pass_name = "gvn" if global_numbering else "lvn"
+        versions = {pass_name: cache.module_versions(sys.modules[__name__])}
+        incremental.run(instrs, [pass_name], lambda missed: lvn(missed, global_numbering), versions, cache.Cache(memo_dir))
+    else:
+        lvn(instrs, global_numbering)
+    wire.write_program(instrs, wire.output_format(sys.argv[1:]))
@@ -0,0 +1,150 @@
+"""
+Function Parallelism
+Cynthia Shao and Jonathan Brown
+
+lvn and dce optimize every function on its own, so a module with many
+functions can be split across a process pool. The functions are cut into
+contiguous chunks of about the same number of instructions and shipped to the
+workers as plain tuples, which pickle much faster than ir.Instr objects. Each
+worker runs a pass's chunk function over its functions and sends back the new
+instructions and the pass counters. Results are put back in the original
+function order and the counters summed, so the output doesn't depend on the
+number of workers or on which finishes first.
+
+Off until set_jobs is given more than one worker (pipeline.py -j N), and
+small modules always run in process since shipping them costs more than
+optimizing them. Shipping is the part that doesn't scale, so pipeline.py
+sends each run of function passes (lvn, guards, dce) in one round trip
+rather than one per pass.
+"""
+
+import atexit
+import gc
+import os
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+import ir
+
+jobs = 1
+_pool = None
+_pool_jobs = 0
+
+# modules with fewer instructions than this aren't worth sending to workers
+MIN_INSTRS = 10000
+# chunks per worker, so one slow chunk doesn't leave the others idle
+CHUNKS_PER_JOB = 4
+
+def set_jobs(n):
+    """use n worker processes, 0 for one per core"""
+    global jobs
+    jobs = n if n > 0 else (os.cpu_count() or 1)
+
+def jobs_arg(argv):
+    """the value given to -j or --jobs (or --jobs=N) in a script's argv, None without it"""
+    for (i, arg) in enumerate(argv):
+        if arg in ("-j", "--jobs"):
+            if i + 1 >= len(argv):
+                raise SystemExit(f"{arg} needs a number of worker processes")
+            return argv[i + 1]
+        if arg.startswith("--jobs="):
+            return arg[len("--jobs="):]
+    return None
+
+def jobs_from_argv(argv):
+    """the number after -j or --jobs in a script's argv, 1 without it"""
+    value = jobs_arg(argv)
+    if value is None:
+        return 1
+    try:
+        return int(value)
+    except ValueError:
+        raise SystemExit("-j needs a number of worker processes")
+
+def pool():
+    """the process pool, started on first use and restarted if jobs changed"""
+    global _pool, _pool_jobs
+    if _pool is not None and _pool_jobs != jobs:
+        _pool.shutdown()
+        _pool = None
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=jobs)
+        _pool_jobs = jobs
+        atexit.register(_pool.shutdown)
+    return _pool
+
+def worth_it(program):
+    if jobs <= 1 or len(program.functions) < 2:
+        return False
+    return sum(len(func.instrs) for func in program.functions) >= MIN_INSTRS
+
+def pack(func):
+    instrs = [(i.op, i.dest, i.type, i.args, i.funcs, i.labels, i.value) for i in func.instrs]
+    return (func.name, func.args, func.type, instrs)
+
+@contextmanager
+def no_gc():
+    """
+    pause the cycle collector: rebuilding a module's worth of instructions
+    otherwise triggers collections that rescan every live object, which
+    costs several times the rebuild itself
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def unpack_instrs(instrs):
+    Instr = ir.Instr
+    return [Instr(*t) for t in instrs]
+
+def chunks(functions, n):
+    """cut functions into at most n contiguous runs of about equal instruction counts"""
+    total = sum(len(func.instrs) for func in functions)
+    target = total / n
+    out = []
+    current = []
+    size = 0
+    for func in functions:
+        current.append(func)
+        size += len(func.instrs)
+        if size >= target and len(out) < n - 1:
+            out.append(current)
+            current = []
+            size = 0
+    if current:
+        out.append(current)
+    return out
+
+def run_chunk(task):
+    """worker side: rebuild the functions, run the pass over them, send back the instrs"""
+    global jobs
+    # workers never start pools of their own
+    jobs = 1
+    chunk_fn, args, names, packed = task
+    with no_gc():
+        functions = [ir.Function(name, fargs, ftype, unpack_instrs(instrs)) for (name, fargs, ftype, instrs) in packed]
+    counters = chunk_fn(ir.Program(functions, names), *args)
+    return [pack(func)[3] for func in functions], counters
+
+def map_functions(program, chunk_fn, *args):
+    """
+    Run chunk_fn(chunk, *args) over the functions of program on the pool, in
+    place, chunk being an ir.Program of some of the functions with program's
+    names. chunk_fn must be a module level function that optimizes the
+    functions in place without interning new names, and returns a dict of
+    counters, which are summed.
+    """
+    groups = chunks(program.functions, jobs * CHUNKS_PER_JOB)
+    tasks = [(chunk_fn, args, program.names, [pack(func) for func in group]) for group in groups]
+    totals = {}
+    for (group, (instrs, counters)) in zip(groups, pool().map(run_chunk, tasks)):
+        with no_gc():
+            for (func, new) in zip(group, instrs):
+                func.instrs = unpack_instrs(new)
+        for (k, v) in counters.items():
+            totals[k] = totals.get(k, 0) + v
+    return totals
@@ -0,0 +1,252 @@
+"""
+Bril Text Parser
+Cynthia Shao and Jonathan Brown
+
+Parses Bril's text form into the same json structure bril2json prints, in
+process, so loading a program doesn't start a child. Files are parsed once
+per run: parse_file keeps each file's json keyed by its content hash and
+remembers the hash by path, mtime and size, so asking again for an unchanged
+file doesn't even read it.
+
+  python parse.py < prog.bril          (like bril2json)
+
+Covers functions with arguments and return types, labels, constants
+(ints, floats, bools, chars, nan and inf), value and effect operations with
+@function and .label operands, and ptr<...> types. Other top level forms
+(imports, structs) raise ParseError.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+
+class ParseError(Exception):
+    pass
+
+TOKEN_RE = re.compile(r"""
+    (?P<space>\s+|\#[^\n]*)
+  | (?P<char>'(?:\\.|[^\\'])')
+  | (?P<func>@[_%A-Za-z][_%.A-Za-z0-9]*)
+  | (?P<label>\.[_%A-Za-z][_%.A-Za-z0-9]*)
+  | (?P<number>-?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][+-]?\d+)?|-inf)
+  | (?P<ident>[_%A-Za-z][_%.A-Za-z0-9]*)
+  | (?P<punct>[(){}<>:;=,])
+""", re.VERBOSE)
+
+ESCAPES = {"0": "\0", "a": "\a", "b": "\b", "t": "\t", "n": "\n", "v": "\v", "f": "\f", "r": "\r"}
+
+def tokenize(text):
+    """(kind, text, position) tokens, comments and whitespace dropped"""
+    tokens = []
+    pos = 0
+    end = len(text)
+    match = TOKEN_RE.match
+    while pos < end:
+        m = match(text, pos)
+        if m is None:
+            raise ParseError(f"line {line_of(text, pos)}: unexpected {text[pos]!r}")
+        kind = m.lastgroup
+        if kind != "space":
+            tokens.append((kind, m.group(), pos))
+        pos = m.end()
+    return tokens
+
+def line_of(text, pos):
+    return text.count("\n", 0, pos) + 1
+
+class Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.i = 0
+
+    def error(self, message):
+        if self.i < len(self.tokens):
+            where = f"line {line_of(self.text, self.tokens[self.i][2])}"
+        else:
+            where = "end of input"
+        return ParseError(f"{where}: {message}")
+
+    def peek(self, offset=0):
+        i = self.i + offset
+        if i < len(self.tokens):
+            return self.tokens[i]
+        return (None, None, len(self.text))
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise self.error("unexpected end of input")
+        self.i += 1
+        return token
+
+    def at(self, text):
+        return self.peek()[1] == text
+
+    def expect(self, text):
+        kind, tok, _ = self.next()
+        if tok != text:
+            self.i -= 1
+            raise self.error(f"expected {text!r}, got {tok!r}")
+
+    def expect_kind(self, kind):
+        k, tok, _ = self.next()
+        if k != kind:
+            self.i -= 1
+            raise self.error(f"expected a {kind}, got {tok!r}")
+        return tok
+
+    def program(self):
+        functions = []
+        while self.peek()[0] is not None:
+            kind, tok, _ = self.peek()
+            if kind != "func":
+                raise self.error(f"expected a function, got {tok!r}")
+            functions.append(self.function())
+        return {"functions": functions}
+
+    def function(self):
+        func = {"name": self.expect_kind("func")[1:]}
+        args = []
+        if self.at("("):
+            self.next()
+            while not self.at(")"):
+                if args:
+                    self.expect(",")
+                name = self.expect_kind("ident")
+                self.expect(":")
+                args.append({"name": name, "type": self.type()})
+            self.next()
+        if args:
+            func["args"] = args
+        if self.at(":"):
+            self.next()
+            func["type"] = self.type()
+        self.expect("{")
+        instrs = []
+        while not self.at("}"):
+            instrs.append(self.instr())
+        self.next()
+        func["instrs"] = instrs
+        return func
+
+    def type(self):
+        name = self.expect_kind("ident")
+        if self.at("<"):
+            self.next()
+            inner = self.type()
+            self.expect(">")
+            return {name: inner}
+        return name
+
+    def instr(self):
+        kind, tok, _ = self.next()
+        if kind == "label":
+            self.expect(":")
+            return {"label": tok[1:]}
+        if kind != "ident":
+            self.i -= 1
+            raise self.error(f"expected an instruction, got {tok!r}")
+        if self.at(":") or self.at("="):
+            instr = {"dest": tok}
+            if self.at(":"):
+                self.next()
+                instr["type"] = self.type()
+            self.expect("=")
+            op = self.expect_kind("ident")
+            instr["op"] = op
+            if op == "const":
+                instr["value"] = self.literal()
+                self.expect(";")
+                return instr
+        else:
+            instr = {"op": tok}
+        args, funcs, labels = [], [], []
+        while not self.at(";"):
+            kind, tok, _ = self.next()
+            if kind == "ident":
+                args.append(tok)
+            elif kind == "func":
+                funcs.append(tok[1:])
+            elif kind == "label":
+                labels.append(tok[1:])
+            else:
+                self.i -= 1
+                raise self.error(f"unexpected {tok!r} in {instr['op']}")
+        self.next()
+        if args:
+            instr["args"] = args
+        if funcs:
+            instr["funcs"] = funcs
+        if labels:
+            instr["labels"] = labels
+        return instr
+
+    def literal(self):
+        kind, tok, _ = self.next()
+        if kind == "number":
+            if tok == "-inf":
+                return float("-inf")
+            if any(c in tok for c in ".eE"):
+                return float(tok)
+            return int(tok)
+        if kind == "char":
+            body = tok[1:-1]
+            if body.startswith("\\"):
+                if body[1] not in ESCAPES:
+                    self.i -= 1
+                    raise self.error(f"unknown escape {tok}")
+                return ESCAPES[body[1]]
+            return body
+        if kind == "ident":
+            if tok in ("true", "false"):
+                return tok == "true"
+            if tok in ("nan", "inf"):
+                return float(tok)
+        self.i -= 1
+        raise self.error(f"expected a literal, got {tok!r}")
+
+def parse(text):
+    """the json dict of a Bril text program"""
+    return Parser(text).program()
+
+# ==== CACHE ====
+
+# content hash -> json string, and path -> (mtime, size, content hash)
+_parsed = {}
+_files = {}
+
+def parse_text(text, digest=None):
+    """the json string of a Bril text program, parsed once per distinct text"""
+    if digest is None:
+        digest = hashlib.sha256(text.encode()).hexdigest()
+    bril_json = _parsed.get(digest)
+    if bril_json is None:
+        bril_json = json.dumps(parse(text))
+        _parsed[digest] = bril_json
+    return bril_json
+
+def parse_file(path):
+    """the json string of a Bril file, only read again once its mtime or size changes"""
+    st = os.stat(path)
+    known = _files.get(path)
+    if known is not None and known[:2] == (st.st_mtime_ns, st.st_size) and known[2] in _parsed:
+        return _parsed[known[2]]
+    with open(path) as f:
+        text = f.read()
+    digest = hashlib.sha256(text.encode()).hexdigest()
+    _files[path] = (st.st_mtime_ns, st.st_size, digest)
+    return parse_text(text, digest)
+
+def main():
+    try:
+        bril = parse(sys.stdin.read())
+    except ParseError as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(bril, indent=2))
+
+if __name__ == "__main__":
+    main()
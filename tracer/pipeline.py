@@ -0,0 +1,196 @@
+"""
+Pass Pipeline
+Cynthia Shao and Jonathan Brown
+
+This script runs the tracer, LVN and DCE in a single process on one in-memory
+Bril program and prints the optimized program as json. It takes the same
+arguments as trace.py plus a pass list, so
+
+  python pipeline.py -std
+
+does the same work as
+
+  python trace.py -std | python lvn.py | python guards.py | python dce.py
+
+without starting three interpreters and re-parsing the json between stages.
+Swap lvn for gvn (-p trace,gvn,guards,dce) to number values across blocks.
+"""
+
+import json
+import sys
+
+import cache
+import ir
+import stats
+import trace
+import lvn
+import guards
+import dce
+import incremental
+import parallel
+import profiles
+import wire
+
+# pass name -> function taking (ir.Program, program_args, trace_options) and returning the new program
+PASSES = {
+    "trace": lambda program, program_args, trace_options: trace.trace_program(program, program_args, **trace_options),
+    "lvn": lambda program, program_args, trace_options: lvn.lvn(program),
+    "gvn": lambda program, program_args, trace_options: lvn.gvn(program),
+    "guards": lambda program, program_args, trace_options: guards.eliminate_guards(program),
+    "dce": lambda program, program_args, trace_options: dce.dce(program),
+}
+
+# module of each pass, its source and that of everything it imports from
+# here versions the pass's output, for cache keys
+PASS_MODULES = {
+    "trace": trace,
+    "lvn": lvn,
+    "gvn": lvn,
+    "guards": guards,
+    "dce": dce,
+}
+
+# passes that only look at one function at a time, so --incremental can
+# skip the functions that haven't changed
+FUNCTION_PASSES = frozenset(["lvn", "gvn", "guards", "dce"])
+
+DEFAULT_PASSES = ["trace", "lvn", "guards", "dce"]
+
+def parse_pass_list(passes):
+    pass_list = [p.strip() for p in passes.split(",") if p.strip()]
+    for p in pass_list:
+        if p not in PASSES:
+            raise ValueError(f"unknown pass '{p}', expected one of {', '.join(PASSES)}")
+    return pass_list
+
+def run_passes(program, pass_list, program_args, trace_options={}, memo=None):
+    """
+    Run each pass in pass_list over the program in order, trace_options are
+    keyword arguments for trace.trace_program. With memo, a cache.Cache of
+    optimized functions, each run of FUNCTION_PASSES only optimizes the
+    functions memo has no result for. With parallel on, each run of
+    FUNCTION_PASSES goes to the process pool in one round trip.
+    """
+    i = 0
+    while i < len(pass_list):
+        if pass_list[i] in FUNCTION_PASSES and (memo is not None or parallel.worth_it(program)):
+            j = i
+            while j < len(pass_list) and pass_list[j] in FUNCTION_PASSES:
+                j += 1
+            segment = pass_list[i:j]
+            if memo is not None:
+                program = incremental.run(program, segment,
+                                          lambda missed: run_passes(missed, segment, program_args, trace_options),
+                                          pass_versions(segment), memo)
+            else:
+                with stats.stage("+".join(segment)):
+                    totals = parallel.map_functions(program, function_passes_chunk, segment)
+                for (name, value) in totals.items():
+                    stats.count(name, value)
+            i = j
+            continue
+        p = pass_list[i]
+        with stats.stage(p):
+            program = PASSES[p](program, program_args, trace_options)
+        i += 1
+    return program
+
+def function_passes_chunk(program, segment):
+    """parallel.map_functions worker: run segment, a run of FUNCTION_PASSES, over the functions of program"""
+    before = dict(stats.counters)
+    run_passes(program, segment, [], {})
+    return {name: value - before.get(name, 0) for (name, value) in stats.counters.items()
+            if name not in before or value != before[name]}
+
+def pass_versions(pass_list):
+    return {p: cache.module_versions(PASS_MODULES[p]) for p in pass_list}
+
+def optimize(bril_json, pass_list, program_args, trace_options={}, result_cache=None, memo=None):
+    """
+    Run the passes over a program given as a json string and return the
+    optimized program as a json dict. With a cache.Cache a hit returns the
+    stored result without tracing or running any pass. memo is the per-function
+    cache for run_passes.
+    """
+    if result_cache is not None:
+        key_options = dict(trace_options)
+        if key_options.get("profile"):
+            # the profile's contents, not its path, decide the result
+            key_options["profile"] = profiles.fingerprint(key_options["profile"])
+        key = cache.cache_key(bril_json, program_args, pass_list, key_options, pass_versions(pass_list))
+        entry = result_cache.get(key)
+        if entry is not None:
+            return entry["program"]
+    recorded = []
+    program = ir.from_json(json.loads(bril_json))
+    program = run_passes(program, pass_list, program_args, dict(trace_options, recorded=recorded), memo)
+    optimized = ir.to_json(program)
+    if result_cache is not None:
+        result_cache.put(key, optimized, recorded)
+    return optimized
+
+def add_cache_options(parser):
+    parser.add_argument('--cache', metavar='DIR',
+                        help='Reuse optimized programs cached in DIR')
+    parser.add_argument('--cache-size', type=float, default=cache.DEFAULT_MAX_BYTES / 2**20,
+                        help='Cache size bound in MiB, least recently used entries are evicted (default: 256)')
+    parser.add_argument('--incremental', metavar='DIR',
+                        help='Only run lvn, gvn, guards and dce on functions whose optimized form is not memoized in DIR')
+
+def open_cache(parsed_args):
+    if not parsed_args.cache:
+        return None
+    return cache.Cache(parsed_args.cache, int(parsed_args.cache_size * 2**20))
+
+def open_memo(parsed_args):
+    if not parsed_args.incremental:
+        return None
+    return cache.Cache(parsed_args.incremental, int(parsed_args.cache_size * 2**20))
+
+def report_cache(counts):
+    print(f"cache: {counts['hits']} hits, {counts['misses']} misses, {counts['evictions']} evictions", file=sys.stderr)
+
+def write_stats(path, result_cache):
+    report = stats.report()
+    if result_cache is not None:
+        report["cache"] = result_cache.counts()
+    if path == "-":
+        json.dump(report, sys.stderr, indent=4)
+        print(file=sys.stderr)
+    else:
+        with open(path, "w") as f:
+            json.dump(report, f, indent=4)
+
+def main():
+    parser = trace.make_parser('Trace and optimize Bril programs in one process')
+    parser.add_argument('-p', '--passes', default=",".join(DEFAULT_PASSES),
+                        help='Comma separated list of passes to run (default: trace,lvn,guards,dce)')
+    add_cache_options(parser)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Worker processes lvn, gvn and dce spread functions over, 0 for all cores (default: 1)')
+    parser.add_argument('--stats', nargs='?', const='-', metavar='FILE',
+                        help='Write per-stage time, memory and pass counters as json to FILE (default: stderr)')
+    parsed_args = parser.parse_args()
+
+    try:
+        pass_list = parse_pass_list(parsed_args.passes)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if parsed_args.stats:
+        stats.enable()
+    parallel.set_jobs(parsed_args.jobs)
+    bril_json, program_args = trace.load_program(parsed_args, parser)
+    result_cache = open_cache(parsed_args)
+    optimized = optimize(bril_json, pass_list, program_args, trace.trace_options(parsed_args), result_cache, open_memo(parsed_args))
+    if parsed_args.format == "binary":
+        wire.write_program(ir.from_json(optimized), "binary")
+    else:
+        wire.write_json(optimized, parsed_args.format)
+    if result_cache is not None:
+        report_cache(result_cache.counts())
+    if parsed_args.stats:
+        write_stats(parsed_args.stats, result_cache)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Edge Profiles
+Cynthia Shao and Jonathan Brown
+
+Runs a program over a set of inputs in the interpreter and adds up how often
+every block ran and every edge between blocks was taken, so the tracer can
+tell a branch that almost always goes one way from one that only went that
+way in the traced run. Blocks are named by their label, the entry block by
+"". Profiles are json, and collecting into an existing file adds to it:
+
+  python profiles.py -f prog.bril -a 8 -a 100 -o prog.profile.json
+  python pipeline.py -f prog.bril 8 --profile prog.profile.json
+
+Without -a the inputs are the ARGS and TRACE_ARG headers of the file.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+
+import interp
+import ir
+import parse
+
+class Profile:
+    def __init__(self):
+        self.runs = 0
+        self.blocks = {}    # (function, label) -> count
+        self.edges = {}     # (function, source label, target label) -> count
+
+    def add_run(self, run):
+        """add the counts of an interp.Interpreter run with profile on"""
+        self.runs += 1
+        for (key, n) in run.block_counts.items():
+            self.blocks[key] = self.blocks.get(key, 0) + n
+        for (key, n) in run.edge_counts.items():
+            self.edges[key] = self.edges.get(key, 0) + n
+
+    def merge(self, other):
+        self.runs += other.runs
+        for (key, n) in other.blocks.items():
+            self.blocks[key] = self.blocks.get(key, 0) + n
+        for (key, n) in other.edges.items():
+            self.edges[key] = self.edges.get(key, 0) + n
+
+    def edge(self, func, source, target):
+        return self.edges.get((func, source, target), 0)
+
+    def branch_share(self, func, source, taken, other):
+        """
+        the share of the runs of a branch at the end of block source that went
+        to taken rather than other, None if the profile never saw it run
+        """
+        went = self.edge(func, source, taken)
+        total = went + self.edge(func, source, other)
+        if total == 0:
+            return None
+        return went / total
+
+    def back_edge_counts(self, func, label_index):
+        """
+        loop header -> times a back-edge to it was taken, for the blocks of
+        func in label_index (a cfg label -> block index map)
+        """
+        counts = {}
+        for ((f, source, target), n) in self.edges.items():
+            if f != func or target not in label_index:
+                continue
+            if label_index[target] <= label_index.get(source, 0):
+                counts[target] = counts.get(target, 0) + n
+        return counts
+
+    def to_json(self):
+        functions = {}
+        for ((func, label), n) in sorted(self.blocks.items()):
+            functions.setdefault(func, {"blocks": {}, "edges": []})["blocks"][label] = n
+        for ((func, source, target), n) in sorted(self.edges.items()):
+            functions.setdefault(func, {"blocks": {}, "edges": []})["edges"].append([source, target, n])
+        return {"runs": self.runs, "functions": functions}
+
+    @staticmethod
+    def from_json(data):
+        profile = Profile()
+        profile.runs = data.get("runs", 0)
+        for (func, counts) in data.get("functions", {}).items():
+            for (label, n) in counts.get("blocks", {}).items():
+                profile.blocks[(func, label)] = n
+            for (source, target, n) in counts.get("edges", []):
+                profile.edges[(func, source, target)] = n
+        return profile
+
+def load(path):
+    with open(path) as f:
+        return Profile.from_json(json.load(f))
+
+def save(profile, path):
+    with open(path, "w") as f:
+        json.dump(profile.to_json(), f, indent=2)
+
+def fingerprint(path):
+    """hash of a profile file, for cache keys"""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def collect(program, inputs):
+    """a Profile of an ir.Program run on each input, a list of argument strings"""
+    profile = Profile()
+    for args in inputs:
+        run = interp.Interpreter(program, out=None, profile=True)
+        try:
+            run.run(args)
+        except interp.BrilError as e:
+            print(f"warning: run on {' '.join(args)} stopped: {e}", file=sys.stderr)
+        profile.add_run(run)
+    return profile
+
+def header_inputs(bril):
+    """the inputs named by a Bril file's ARGS and TRACE_ARG headers"""
+    inputs = []
+    for header in ("ARGS", "TRACE_ARG"):
+        match = re.search(rf"{header}: (.*)", bril)
+        if match and match.group(1).split() not in inputs:
+            inputs.append(match.group(1).split())
+    return inputs
+
+def main():
+    parser = argparse.ArgumentParser(description='Collect block and edge counts of a Bril program over inputs')
+    parser.add_argument('-f', '--file', required=True, help='Bril file to profile')
+    parser.add_argument('-a', '--args', action='append', default=[],
+                        help='Arguments of one run, space separated, repeat for more runs')
+    parser.add_argument('-o', '--output', help='Profile file to add the counts to (default: print them)')
+    parsed_args = parser.parse_args()
+
+    with open(parsed_args.file) as f:
+        bril = f.read()
+    try:
+        program = ir.from_json(parse.parse(bril))
+    except parse.ParseError as e:
+        parser.error(f"{parsed_args.file}: {e}")
+    inputs = [a.split() for a in parsed_args.args] or header_inputs(bril)
+    if not inputs:
+        parser.error("no inputs: pass -a or give the file an ARGS header")
+    profile = collect(program, inputs)
+    if parsed_args.output is None:
+        json.dump(profile.to_json(), sys.stdout, indent=2)
+        print()
+        return
+    if os.path.exists(parsed_args.output):
+        profile.merge(load(parsed_args.output))
+    save(profile, parsed_args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Pipeline Stats
+Cynthia Shao and Jonathan Brown
+
+Wall time, peak memory and transformation counters for the pipeline stages,
+collected when pipeline.py runs with --stats. Stages can nest (the trace
+stages are generators feeding each other), so time and memory are charged to
+whichever stage is innermost at the moment: every begin/end closes the current
+interval and gives it to the stage on top of the stack. Peak memory is the
+peak of Python allocations seen by tracemalloc while the stage was on top,
+plus the max RSS of child processes (brili with --tracer brili) for stages that run
+one. Everything here is a no-op until enable() is called.
+"""
+
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+enabled = False
+stages = {}
+counters = {}
+_stack = []
+_last = 0.0
+
+def enable():
+    global enabled, _last
+    enabled = True
+    tracemalloc.start()
+    _last = time.perf_counter()
+
+def _switch():
+    """charge the time and memory since the last event to the innermost stage"""
+    global _last
+    now = time.perf_counter()
+    if _stack:
+        rec = stages.setdefault(_stack[-1], {"seconds": 0.0, "peak_bytes": 0})
+        rec["seconds"] += now - _last
+        rec["peak_bytes"] = max(rec["peak_bytes"], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    _last = now
+
+def begin(name):
+    if enabled:
+        _switch()
+        _stack.append(name)
+
+def end():
+    if enabled:
+        _switch()
+        _stack.pop()
+
+@contextmanager
+def stage(name):
+    begin(name)
+    try:
+        yield
+    finally:
+        end()
+
+def timed(name, iterable):
+    """pass a generator through, charging the work done to produce each item to name"""
+    if not enabled:
+        yield from iterable
+        return
+    it = iter(iterable)
+    while True:
+        begin(name)
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            end()
+        yield item
+
+def child_rss(name):
+    """record the max RSS of the child processes waited for so far under stage name"""
+    if enabled:
+        rss_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        rec = stages.setdefault(name, {"seconds": 0.0, "peak_bytes": 0})
+        rec["child_max_rss_kb"] = max(rec.get("child_max_rss_kb", 0), rss_kb)
+
+def count(name, n=1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+def report():
+    return {"stages": stages, "counters": counters}
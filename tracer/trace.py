@@ -12,52 +12,46 @@ import sys
 import re
 import argparse
 
+import cfg
+import interp
+import ir
+import parse
+import profiles
+import stats
+import wire
+
 ARGS_RE = r"TRACE_ARG: (.*)"
 
-def run_cmd(cmd):
-    """
-    run shell commands and return stdout
-    """
-    result = subprocess.run(
-      cmd,
-      shell=True,
-      capture_output=True,
-      text=True
-    )
-    
-    if result.returncode != 0:
-      print(f"Error running: {cmd}", file=sys.stderr)
-      print(result.stderr, file=sys.stderr)
-      sys.exit(1)
-    
-    return result.stdout
-  
-def main():
-  parser = argparse.ArgumentParser(description='Trace and optimize Bril programs')
-  parser.add_argument('-f', '--file', action='store_true', 
-                      help='Read from file (default behavior)')
-  parser.add_argument('-std', '--stdin', action='store_true',
-                      help='Read from stdin (for brench compatibility)')
-  parser.add_argument('input', nargs='?', help='Input Bril file (or args if using stdin)')
-  parser.add_argument('args', nargs='*', help='Program arguments')
-  
-  parsed_args = parser.parse_args()
-  
-  # Determine mode
+def parse_bril(bril):
+  """
+  turn Bril text into its json form, exits like bril2json on a syntax error
+  """
+  try:
+    return parse.parse_text(bril)
+  except parse.ParseError as e:
+    print(f"Error parsing Bril: {e}", file=sys.stderr)
+    sys.exit(1)
+
+def parse_bril_file(path):
+  try:
+    return parse.parse_file(path)
+  except OSError as e:
+    print(f"Error reading {path}: {e}", file=sys.stderr)
+    sys.exit(1)
+  except parse.ParseError as e:
+    print(f"Error parsing {path}: {e}", file=sys.stderr)
+    sys.exit(1)
+
+def load_program(parsed_args, parser):
+  """
+  read the Bril program and its arguments from stdin or a file,
+  returns (bril_json, program_args)
+  """
   if parsed_args.stdin or (not parsed_args.file and not parsed_args.input):
-    # Stdin mode: read Bril from stdin, args from command line
+    # Stdin mode: read Bril from stdin, args from TRACE_ARG header
     bril = sys.stdin.read()
-    result = subprocess.run(
-        ["bril2json"],
-        input=bril,
-        text=True,
-        capture_output=True
-    )
-    if result.returncode != 0:
-        print(f"Error running bril2json", file=sys.stderr)
-        print(result.stderr, file=sys.stderr)
-        sys.exit(1)
-    bril_json = result.stdout
+    with stats.stage("parse"):
+      bril_json = parse_bril(bril)
     match = re.search(ARGS_RE, bril)
     args = match.group(1) if match else ""
     program_args = [args]
@@ -67,101 +61,778 @@ def main():
       parser.error("File path required when not using stdin mode")
     bril = parsed_args.input
     program_args = parsed_args.args
-    bril_json = run_cmd(f"bril2json < {bril}")
-  
-  original_program = json.loads(bril_json)
-  
-  # Run with brili to get trace
-  args_str = " ".join(program_args)
-  if parsed_args.stdin or (not parsed_args.file and not parsed_args.input):
-    # In stdin mode, pipe the already-read Bril content
-    trace_output = subprocess.run(
-      f"brili -t {args_str}".split(),
-      input=bril_json,
-      text=True,
-      capture_output=True
-    ).stdout
-  else:
-    # In file mode, use the original command
-    trace_output = run_cmd(f"bril2json < {bril} | brili -t {args_str}")
-  
-  trace = []
-  actual_output = []
-  for line in trace_output.strip().split('\n'):
-    if line:
+    with stats.stage("parse"):
+      bril_json = parse_bril_file(bril)
+  return bril_json, program_args
+
+def program_words(program_args):
+  """
+  the arguments to pass main, the stdin mode passes the whole TRACE_ARG
+  header as one string
+  """
+  return [word for arg in program_args for word in arg.split()]
+
+def stream_trace(program, program_args, budget=None, tracer="interp", max_inline=0, bodies=None, retrace=False):
+  """
+  run the program on program_args and yield the instructions of main it
+  traced, as ir.Instrs, stopping once budget instructions have been yielded.
+  The interp tracer runs it in process and stops the program with the trace;
+  brili runs `brili -t` and drops the program output interleaved with it.
+  With the interp tracer and max_inline, the instructions each call ran are
+  recorded too (up to max_inline per call) and put in bodies, see split_calls,
+  and retrace keeps recording through jumps back into the trace.
+  """
+  if budget is not None and budget <= 0:
+    return
+  if tracer == "brili":
+    yield from stream_brili_trace(program, program_args, budget)
+    return
+  run = interp.tracer(program, budget, max_inline, retrace)
+  try:
+    yield from split_calls(run.stream(program_words(program_args)), {} if bodies is None else bodies)
+  finally:
+    stats.count("trace_length", run.recorded)
+    stats.count("trace_dyn_instrs", run.dyn_count)
+    if run.error is not None:
+      stats.count("trace_errors")
+
+def stream_brili_trace(program, program_args, budget):
+  proc = subprocess.Popen(
+    ["brili", "-t", *program_words(program_args)],
+    stdin=subprocess.PIPE,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.DEVNULL,
+    text=True
+  )
+  try:
+    proc.stdin.write(json.dumps(ir.to_json(program)))
+    proc.stdin.close()
+    count = 0
+    for line in proc.stdout:
+      # trace lines are json objects, anything else is program output
+      if not line.startswith("{"):
+        continue
       try:
         instr = json.loads(line)
-        # Only add dictionaries (instructions) to trace
-        if isinstance(instr, dict):
-          trace.append(instr)
-        else:
-          # This is program output (numbers, strings, etc.)
-          actual_output.append(str(instr))
       except json.JSONDecodeError:
-        actual_output.append(line)
+        continue
+      if isinstance(instr, dict):
+        count += 1
+        stats.count("trace_length")
+        yield ir.instr_from_json(instr, program.names)
+        if budget is not None and count >= budget:
+          break
+  finally:
+    if proc.poll() is None:
+      proc.kill()
+    proc.stdout.close()
+    proc.wait()
+    stats.child_rss("brili_trace")
 
-  transformed_trace, side_effects_trace = guard_trace(trace)
-  stitched_program = stitch_trace(original_program, transformed_trace, side_effects_trace)
-  # optimized_program = optimize(stitched_program)
-  json.dump(stitched_program, sys.stdout, indent=2)
+def split_calls(records, bodies):
+  """
+  yield the instructions main ran from the (instr, depth) records of a trace,
+  putting id of a call -> [(instr, depth)] the callee ran for it into bodies,
+  for the calls whose whole body was recorded and has no speculation of its
+  own. Only the body of the call being run is held, and a call is yielded
+  once its body is over so it is in bodies by then.
+  """
+  call = None
+  body = []
+  for (instr, depth) in records:
+    if depth > 0:
+      body.append((instr, depth))
+      continue
+    if call is not None:
+      keep_body(call, body, bodies)
+      yield call
+      call = None
+      body = []
+    if instr.op == ir.CALL:
+      call = instr
+    else:
+      yield instr
+  if call is not None:
+    keep_body(call, body, bodies)
+    yield call
+
+def keep_body(call, body, bodies):
+  if body and body[-1][1] == 1 and body[-1][0].op == ir.RET and \
+      not any(b.op in SPECULATION_OPS for (b, _) in body):
+    bodies[id(call)] = body
 
-def guard_trace(trace):
-  new_trace = []
+def record_into(trace, recorded, names):
+  """pass the trace through, appending the json form of each instruction to recorded"""
+  for instr in trace:
+    recorded.append(ir.instr_to_json(instr, names))
+    yield instr
+
+def trace_program(program, program_args, select="entry", iterations=1, max_trace=None, recorded=None, tracer="interp",
+                  max_inline=0, branches=0, profile=None, min_bias=0.9):
+  """
+  trace an ir.Program on program_args and stitch the speculative trace into main,
+  the program is modified in place and returned.
+  select="entry" speculates on the trace from the top of main, select="loop"
+  speculates on `iterations` iterations of the hottest loop in main instead.
+  max_trace caps the number of trace instructions that get stitched in, in
+  entry mode tracing stops once it has traced that many.
+  tracer is "interp" to trace in process or "brili" to run brili -t.
+  Calls in the entry trace that ran at most max_inline instructions are
+  inlined, with the interp tracer, and the trace stops before any other call.
+  In loop mode with the interp tracer and branches, the loop is traced into a
+  trace tree of up to branches more traces for its other frequent paths, see
+  select_loop_tree.
+  profile is a profiles.py file: loops are picked by its back-edge counts, and
+  branches of main that went the traced way less than min_bias of the time
+  stay branches that leave the trace, see SideExits.
+  If recorded is a list the trace is appended to it as json.
+  """
+  main_func = program.function("main")
+  if not main_func:
+    print("error no main found", file=sys.stderr)
+    sys.exit(1)
+  var_types = function_var_types(main_func)
   side_effects = []
-  
+  bodies = {}
+  if profile is not None:
+    profile = profiles.load(profile)
+  side_exits = SideExits(main_func, profile, min_bias)
+
+  if select == "loop":
+    tree = branches > 0 and tracer == "interp"
+    budget = TREE_RECORD_BUDGET if tree else None
+    trace = stats.timed(tracer + "_trace", stream_trace(program, program_args, budget, tracer, max_inline, bodies, tree))
+    if recorded is not None:
+      trace = record_into(trace, recorded, program.names)
+    raw = list(trace)
+    trace = list(complete_trace(raw, main_func))
+    with stats.stage("select_loop"):
+      if tree:
+        selected = select_loop_tree(trace, main_func, iterations, max_trace, branches, profile)
+      else:
+        selected = select_loop_trace(trace, main_func, iterations, max_trace, profile)
+        if selected is not None:
+          selected = (selected[0], [selected[1]], [])
+    if selected is not None:
+      header, paths, parents = selected
+      exit_label = fresh_label(main_func, header + ".original")
+      return stitch_loop_tree(program, header, exit_label, paths, parents, var_types, side_exits)
+    # no loop to speculate on, fall back to the entry trace
+    if tree:
+      trace = list(complete_trace(first_pass(raw), main_func))
+    if max_trace is not None:
+      trace = trace[:max_trace]
+  else:
+    trace = stats.timed(tracer + "_trace", stream_trace(program, program_args, max_trace, tracer, max_inline, bodies))
+    if recorded is not None:
+      trace = record_into(trace, recorded, program.names)
+
+  completed = complete_trace(stop_at_calls(trace, bodies), main_func)
+  exits = {}
+  if profile is not None:
+    completed = list(completed)
+    exits = side_exits.unbiased(completed)
+  completed = inline_calls(completed, bodies, program, var_types)
+  transformed_trace = guard_trace(completed, program.names, var_types, side_effects, exits=exits, side_exits=side_exits)
+  with stats.stage("stitch_trace"):
+    return stitch_trace(program, stats.timed("guard_trace", transformed_trace), side_effects, side_exits.stubs)
+
+def add_trace_options(parser):
+  parser.add_argument('--select', choices=['entry', 'loop'], default='entry',
+                      help='Speculate on the trace from the top of main (entry) or on the hottest loop (loop)')
+  parser.add_argument('--iterations', type=int, default=1,
+                      help='Loop iterations per speculative region with --select loop (default: 1)')
+  parser.add_argument('--max-trace', type=int, default=None,
+                      help='Maximum number of trace instructions to stitch in')
+  parser.add_argument('--tracer', choices=['interp', 'brili'], default='interp',
+                      help='Trace with the in-process interpreter (interp) or by running brili -t (brili)')
+  parser.add_argument('--branches', type=int, default=2,
+                      help='With --select loop, secondary traces for other frequent paths through the loop, 0 for one trace (default: 2)')
+  parser.add_argument('--profile', metavar='FILE',
+                      help='Edge profile from profiles.py to pick loops and decide which branches to guard with')
+  parser.add_argument('--min-bias', type=float, default=0.9,
+                      help='With --profile, share of runs a branch must go the traced way to be guarded (default: 0.9)')
+  parser.add_argument('--max-inline', type=int, default=1000,
+                      help='Inline calls on the entry trace that ran at most this many instructions, 0 to keep every call (default: 1000)')
+
+def trace_options(parsed_args):
+  """keyword arguments for trace_program from parsed add_trace_options flags"""
+  return {
+    "select": parsed_args.select,
+    "iterations": parsed_args.iterations,
+    "max_trace": parsed_args.max_trace,
+    "tracer": parsed_args.tracer,
+    "max_inline": parsed_args.max_inline,
+    "branches": parsed_args.branches,
+    "profile": parsed_args.profile,
+    "min_bias": parsed_args.min_bias,
+  }
+
+def make_parser(description):
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('-f', '--file', action='store_true', 
+                      help='Read from file (default behavior)')
+  parser.add_argument('-std', '--stdin', action='store_true',
+                      help='Read from stdin (for brench compatibility)')
+  parser.add_argument('input', nargs='?', help='Input Bril file (or args if using stdin)')
+  parser.add_argument('args', nargs='*', help='Program arguments')
+  add_trace_options(parser)
+  wire.add_format_options(parser)
+  return parser
+
+def main():
+  parser = make_parser('Trace and optimize Bril programs')
+  parsed_args = parser.parse_args()
+  bril_json, program_args = load_program(parsed_args, parser)
+
+  original_program = ir.from_json(json.loads(bril_json))
+  stitched_program = trace_program(original_program, program_args, **trace_options(parsed_args))
+  # optimized_program = optimize(stitched_program)
+  wire.write_program(stitched_program, parsed_args.format)
+
+def complete_trace(trace, func):
+  """
+  pass the trace through and end it with the way it leaves main's code:
+  brili -t stops tracing on the jump back to a label it has already traced
+  without printing it, so that jump is put back, followed by its target label
+  when it is a branch with only one traced target. A trace cut off by the
+  budget ends with a jump to a label added in func where it stopped, and one
+  that ran off the end of main ends with a ret. Nothing is added if the trace
+  doesn't line up with func.
+  """
+  graph = cfg.build(func)
+  traced = set()
+  pos = 0
+  last = None
   for instr in trace:
-    # Skip labels and jumps in trace
-    if "label" in instr or instr.get("op") == "jmp":
-      continue
-    elif "op" in instr and instr.get("op") == "print":
-      side_effect = instr.copy()
-      side_effects.append(side_effect)
+    if instr.op == ir.LABEL:
+      pos = graph.label_position(instr.labels[0]) + 1
+      traced.add(instr.labels[0])
+    else:
+      pos += 1
+    last = instr
+    yield instr
+
+  if last is None or last.op in ir.TERMINATORS:
+    return
+  if pos > len(func.instrs) or func.instrs[pos - 1].op != last.op:
+    return
+  if pos == len(func.instrs):
+    yield ir.Instr(ir.RET)
+    return
+  instr = func.instrs[pos]
+  if instr.op == ir.JMP:
+    yield instr
+  elif instr.op == ir.BR:
+    yield instr
+    targets = {l for l in instr.labels if l in traced}
+    if len(targets) == 1:
+      yield ir.Instr.label(targets.pop())
+  else:
+    if instr.op == ir.LABEL:
+      target = instr.labels[0]
+    else:
+      target = fresh_label(func, "resume")
+      func.instrs.insert(pos, ir.Instr.label(target))
+    yield ir.Instr(ir.JMP, labels=(target,))
+
+# INLINING
+
+SPECULATION_OPS = frozenset([ir.SPECULATE, ir.COMMIT, ir.GUARD])
+
+def stop_at_calls(trace, bodies):
+  """
+  pass the trace through up to the first call that won't be inlined. The
+  callee would print as it runs, ahead of the prints deferred to the commit,
+  and a failed guard can't take its effects back, so the speculative region
+  ends before it and complete_trace jumps back to main there.
+  """
+  for instr in trace:
+    if instr.op == ir.CALL and id(instr) not in bodies:
+      stats.count("trace_call_stops")
+      return
+    yield instr
+
+def inline_calls(trace, bodies, program, var_types):
+  """
+  pass the trace through with every call that has a recorded body replaced by
+  the instructions the callee ran: its locals renamed apart per activation,
+  its arguments copied into its parameters and its ret copied into the call's
+  dest. Nested calls are spliced in the same way, so the speculative region
+  runs no calls at all. var_types gets the types of the renamed locals.
+  """
+  names = program.names
+  functions = {func.name: func for func in program.functions}
+  activations = 0
+  for instr in trace:
+    body = bodies.get(id(instr)) if instr.op == ir.CALL else None
+    if body is None:
+      yield instr
       continue
-    # Convert branches to guards
-    elif instr.get("op") == "br":
-      new_instr = {
-          "op": "guard",
-          "args": instr["args"],
-          "labels": ["original_code"]
-      }
+    stats.count("calls_inlined")
+    # one (renaming, call) per active call, the caller of the top one is main
+    frames = [({}, None)]
+    calls = [instr]
+    for (callee_instr, depth) in body:
+      if len(frames) < depth + 1:
+        call = calls[-1]
+        callee = functions[call.funcs[0]]
+        activations += 1
+        suffix = f"{callee.name}{activations}"
+        caller_vars = frames[-1][0]
+        renamed = {}
+        for ((param, typ), arg) in zip(callee.args, call.args):
+          new = names.fresh(f"{names.name(param)}.{suffix}")
+          renamed[param] = new
+          var_types[new] = typ
+          yield ir.Instr(ir.ID, new, typ, (caller_vars.get(arg, arg),))
+        frames.append((renamed, suffix))
+      renamed, suffix = frames[-1]
+
+      def rename(var):
+        new = renamed.get(var)
+        if new is None:
+          new = renamed[var] = names.fresh(f"{names.name(var)}.{suffix}")
+        return new
+
+      copy = callee_instr.copy()
+      copy.args = tuple(rename(a) for a in copy.args)
+      if copy.op == ir.RET:
+        frames.pop()
+        call = calls.pop()
+        if call.dest is not None and copy.args:
+          dest = frames[-1][0].get(call.dest, call.dest)
+          var_types[dest] = call.type
+          yield ir.Instr(ir.ID, dest, call.type, copy.args)
+        continue
+      if copy.dest is not None:
+        copy.dest = rename(copy.dest)
+        var_types[copy.dest] = copy.type
+      if copy.op == ir.CALL:
+        calls.append(copy)
+        continue
+      yield copy
+
+def function_var_types(func):
+  """variable id -> type for the args and dests of a function"""
+  var_types = {}
+  for (arg, typ) in func.args:
+    var_types[arg] = typ
+  for instr in func.instrs:
+    if instr.dest is not None and instr.type is not None:
+      var_types[instr.dest] = instr.type
+  return var_types
+
+def taken_label(trace, i):
+  """the label control went to after the jump at trace[i], None if the trace ends first"""
+  if i + 1 < len(trace) and trace[i + 1].op == ir.LABEL:
+    return trace[i + 1].labels[0]
+  return None
+
+def guard_trace(trace, names, var_types, side_effects, exit_label="original_code", exits={}, side_exits=None):
+  """
+  turn a recorded trace into straight-line speculative code, yielding the new
+  instructions as the trace is consumed. Branches become guards on the
+  direction that was taken, and prints are split into a copy of their args
+  inside the trace plus the print itself, which is added to side_effects so it
+  can run after commit. A jump or ret at the very end of the trace is where it
+  leaves and is yielded as is, a trace ending on a label leaves with a jump to it.
+  A branch whose id is in exits guards to exits[id] instead of exit_label, or
+  stays a branch out of the trace through side_exits if that is KEEP_BRANCH.
+  """
+  prev = None
+  for instr in trace:
+    if prev is not None:
+      target = exits.get(id(prev), exit_label)
+      if target is KEEP_BRANCH:
+        yield from side_exits.branch(prev, instr, side_effects)
+      else:
+        yield from guard_instr(prev, instr, names, var_types, side_effects, target)
+    prev = instr
+  if prev is not None:
+    if prev.op in ir.TERMINATORS:
+      yield prev
+    elif prev.op == ir.LABEL:
+      yield ir.Instr(ir.JMP, labels=prev.labels)
     else:
-      new_instr = instr.copy()
-    
-    new_trace.append(new_instr)
-  
-  return new_trace, side_effects
-
-def stitch_trace(program, trace, sd_effects):
-  main_func = None
-  for func in program["functions"]:
-    if func["name"] == "main":
-      main_func = func
-      break
+      yield from guard_instr(prev, None, names, var_types, side_effects, exits.get(id(prev), exit_label))
+
+def guard_instr(instr, next_instr, names, var_types, side_effects, exit_label):
+  # Skip labels and jumps in trace
+  if instr.op == ir.LABEL or instr.op == ir.JMP:
+    return
+  elif instr.op == ir.PRINT:
+    # snapshot the values so later writes in the trace don't change what gets printed
+    copies = []
+    for arg in instr.args:
+      copy = names.fresh(names.name(arg))
+      yield ir.Instr(ir.ID, copy, var_types.get(arg), (arg,))
+      copies.append(copy)
+    side_effects.append(ir.Instr(ir.PRINT, args=tuple(copies)))
+  # Convert branches to guards
+  elif instr.op == ir.BR:
+    cond = instr.args[0]
+    taken = next_instr.labels[0] if next_instr is not None and next_instr.op == ir.LABEL else None
+    if taken is not None and taken == instr.labels[1] and instr.labels[0] != instr.labels[1]:
+      # the false edge was taken, guard on the negated condition
+      negated = names.fresh(names.name(cond))
+      yield ir.Instr(ir.NOT, negated, "bool", (cond,))
+      cond = negated
+    stats.count("guards_emitted")
+    yield ir.Instr(ir.GUARD, args=(cond,), labels=(exit_label,))
+  else:
+    yield instr
+
+# LOOP TRACE SELECTION
+
+# ops whose effects speculation can't roll back, loop traces containing them are skipped
+UNSAFE_OPS = frozenset([ir.CALL, ir.STORE, ir.ALLOC, ir.FREE])
+
+def find_back_edges(trace, label_index):
+  """
+  (trace index, target label) for every taken jump in the trace whose target
+  comes no later in the function than the block the jump is in, label_index
+  is the function's cfg label -> block index map
+  """
+  back_edges = []
+  current = -1
+  for (i, instr) in enumerate(trace):
+    if instr.op == ir.LABEL:
+      current = label_index.get(instr.labels[0], current)
+    elif instr.op == ir.JMP or instr.op == ir.BR:
+      target = instr.labels[0] if instr.op == ir.JMP else taken_label(trace, i)
+      if target in label_index and label_index[target] <= current:
+        back_edges.append((i, target))
+  return back_edges
+
+def loop_iterations(trace, header, back_edges):
+  """(start, end) trace slices running from the header label to its back-edge jump"""
+  ends = [i for (i, target) in back_edges if target == header]
+  iterations = []
+  start = None
+  end_idx = 0
+  for (i, instr) in enumerate(trace):
+    if start is None and instr.op == ir.LABEL and instr.labels[0] == header:
+      start = i
+    while end_idx < len(ends) and ends[end_idx] < i:
+      end_idx += 1
+    if start is not None and end_idx < len(ends) and ends[end_idx] == i:
+      iterations.append((start, i + 1))
+      start = None
+  return iterations
+
+def loop_order(back_edges, func, profile):
+  """
+  headers of the recorded loops, hottest first: by the profile's back-edge
+  counts when there is one, then by the recorded ones, then by first entered
+  """
+  counts = {}
+  for (_, target) in back_edges:
+    counts[target] = counts.get(target, 0) + 1
+  profiled = profile.back_edge_counts(func.name, cfg.build(func).label_index) if profile is not None else {}
+  return sorted(counts, key=lambda h: (-profiled.get(h, 0), -counts[h]))
+
+def select_loop_trace(trace, func, iterations, max_trace, profile=None):
+  """
+  count back-edges in the trace and return (header label, trace slice) covering
+  up to `iterations` consecutive iterations of the hottest loop that fit in
+  max_trace and are safe to speculate on, or None if there is no such loop.
+  If fewer iterations were recorded the slice is unrolled to make up the rest.
+  """
+  back_edges = find_back_edges(trace, cfg.build(func).label_index)
+  for header in loop_order(back_edges, func, profile):
+    slices = loop_iterations(trace, header, back_edges)
+    for (k, (start, end)) in enumerate(slices):
+      if any(instr.op in UNSAFE_OPS for instr in trace[start:end]):
+        continue
+      if max_trace is not None and end - start > max_trace:
+        continue
+      # extend with the iterations that directly follow this one
+      for (next_start, next_end) in slices[k + 1:k + iterations]:
+        if next_start != end or any(instr.op in UNSAFE_OPS for instr in trace[next_start:next_end]):
+          break
+        if max_trace is not None and next_end - start > max_trace:
+          break
+        end = next_end
+      recorded = sum(1 for (s, e) in slices if start <= s and e <= end)
+      group = trace[start:end]
+      if group[-1].op == ir.BR:
+        # keep the direction of the back-edge branch
+        group.append(ir.Instr.label(header))
+      # unroll the recorded iterations when brili traced fewer than asked for
+      repeats = max(1, iterations // recorded)
+      if max_trace is not None:
+        repeats = max(1, min(repeats, max_trace // len(group)))
+      loop_trace = [instr.copy() for _ in range(repeats) for instr in group]
+      return header, loop_trace
+  return None
+
+# TRACE TREES
+
+# instructions recorded to find a loop's paths for a trace tree
+TREE_RECORD_BUDGET = 20000
+# share of the recorded iterations a path needs to get a trace of its own
+MIN_BRANCH_SHARE = 0.1
+
+def first_pass(trace):
+  """the trace up to the first jump back into it, what brili -t would have recorded"""
+  seen = set()
+  for (i, instr) in enumerate(trace):
+    if instr.op == ir.LABEL:
+      seen.add(instr.labels[0])
+    elif instr.op == ir.JMP or instr.op == ir.BR:
+      target = instr.labels[0] if instr.op == ir.JMP else taken_label(trace, i)
+      if target in seen:
+        return trace[:i]
+  return trace
+
+def path_groups(trace, header, back_edges, iterations, max_trace):
+  """
+  the recorded runs of `iterations` consecutive iterations of the loop at
+  header, as trace slices that are safe to speculate on and fit in max_trace
+  """
+  groups = []
+  slices = loop_iterations(trace, header, back_edges)
+  for k in range(0, len(slices) - iterations + 1, iterations):
+    run = slices[k:k + iterations]
+    if any(run[j + 1][0] != run[j][1] for j in range(len(run) - 1)):
+      continue
+    start, end = run[0][0], run[-1][1]
+    if max_trace is not None and end - start > max_trace:
+      continue
+    group = trace[start:end]
+    if any(instr.op in UNSAFE_OPS for instr in group):
+      continue
+    if group[-1].op == ir.BR:
+      group.append(ir.Instr.label(header))
+    groups.append(group)
+  return groups
+
+def divergence(parent, child):
+  """
+  (common prefix length, the branch in parent where child goes the other
+  way) comparing the blocks the two paths run through, branch None if child
+  doesn't leave parent at a branch
+  """
+  parent_labels = [i for (i, instr) in enumerate(parent) if instr.op == ir.LABEL]
+  child_labels = [instr.labels[0] for instr in child if instr.op == ir.LABEL]
+  k = 0
+  while k < len(parent_labels) and k < len(child_labels) and parent[parent_labels[k]].labels[0] == child_labels[k]:
+    k += 1
+  if k == 0 or k == len(parent_labels):
+    return k, None
+  branch = parent[parent_labels[k] - 1]
+  return k, branch if branch.op == ir.BR else None
+
+def select_loop_tree(trace, func, iterations, max_trace, branches, profile=None):
+  """
+  Group the recorded iterations of the hottest loop safe to speculate on by
+  the blocks they run through, and return (header, paths, parents): paths[0]
+  is the most frequent path, then up to `branches` other paths taken by at
+  least MIN_BRANCH_SHARE of the iterations. parents[i] is (index of the path
+  paths[i + 1] leaves, the branch in it where it does). None if no loop fits.
+  """
+  back_edges = find_back_edges(trace, cfg.build(func).label_index)
+  for header in loop_order(back_edges, func, profile):
+    groups = path_groups(trace, header, back_edges, iterations, max_trace)
+    if not groups:
+      continue
+    by_path = {}
+    for group in groups:
+      path = tuple(instr.labels[0] for instr in group if instr.op == ir.LABEL)
+      if path not in by_path:
+        by_path[path] = [group, 0]
+      by_path[path][1] += 1
+    # most frequent first, ties go to the path seen first
+    ranked = sorted(by_path.values(), key=lambda entry: -entry[1])
+    paths = [[instr.copy() for instr in ranked[0][0]]]
+    parents = []
+    taken = set()
+    for (group, count) in ranked[1:]:
+      if len(paths) > branches or count < max(2, MIN_BRANCH_SHARE * len(groups)):
+        break
+      # hang it off the path it shares the longest prefix with
+      best = max(range(len(paths)), key=lambda p: divergence(paths[p], group)[0])
+      _, branch = divergence(paths[best], group)
+      if branch is None or id(branch) in taken:
+        continue
+      taken.add(id(branch))
+      parents.append((best, branch))
+      paths.append([instr.copy() for instr in group])
+    stats.count("trace_branches", len(paths) - 1)
+    return header, paths, parents
+  return None
+
+# SIDE EXITS
+
+# exits value for a branch that stays a branch
+KEEP_BRANCH = object()
+
+class SideExits:
+  """
+  Branches of a trace that a profile says aren't biased enough to guard. One
+  stays a br: the way the trace went continues in the trace, the other goes to
+  a stub that commits, runs the side effects deferred so far and jumps to the
+  branch's target in the original code. Leaving that way keeps the work done
+  so far instead of rolling it back. The stubs are placed after the trace.
+  """
+
+  def __init__(self, func, profile=None, min_bias=0.9):
+    self.func = func
+    self.profile = profile
+    self.min_bias = min_bias
+    self.used = set(cfg.build(func).label_index)
+    self.stubs = []
+
+  def label(self, base):
+    label = base
+    i = 0
+    while label in self.used:
+      i += 1
+      label = f"{base}.{i}"
+    self.used.add(label)
+    return label
+
+  def unbiased(self, trace):
+    """exits entries for the branches of main in trace not biased enough to guard"""
+    exits = {}
+    if self.profile is None:
+      return exits
+    block = ""
+    for (i, instr) in enumerate(trace):
+      if instr.op == ir.LABEL:
+        block = instr.labels[0]
+      elif instr.op == ir.BR and instr.labels[0] != instr.labels[1]:
+        taken = taken_label(trace, i)
+        if taken is None:
+          continue
+        other = instr.labels[1] if taken == instr.labels[0] else instr.labels[0]
+        share = self.profile.branch_share(self.func.name, block, taken, other)
+        if share is not None and share < self.min_bias:
+          exits[id(instr)] = KEEP_BRANCH
+    return exits
+
+  def branch(self, instr, next_instr, side_effects):
+    # unbiased only picks branches followed by the label they went to
+    taken = next_instr.labels[0]
+    other = instr.labels[1] if taken == instr.labels[0] else instr.labels[0]
+    stay = self.label("trace.stay")
+    leave = self.label("trace.leave")
+    stats.count("branches_kept")
+    labels = (stay, leave) if taken == instr.labels[0] else (leave, stay)
+    yield ir.Instr(ir.BR, args=instr.args, labels=labels)
+    yield ir.Instr.label(stay)
+    self.stubs.append(ir.Instr.label(leave))
+    self.stubs.append(ir.Instr(ir.COMMIT))
+    self.stubs.extend(effect.copy() for effect in side_effects)
+    self.stubs.append(ir.Instr(ir.JMP, labels=(other,)))
+
+def fresh_label(func, base):
+  labels = cfg.build(func).label_index
+  label = base
+  i = 0
+  while label in labels:
+    i += 1
+    label = f"{base}.{i}"
+  return label
+
+def loop_region(trace, sd_effects, header):
+  """a speculative loop trace wrapped in speculate and commit, looping back to header"""
+  body = list(trace)
+  if body and body[-1].op in ir.TERMINATORS:
+    # the recorded back-edge, replaced by the jump to the header below
+    body.pop()
+  loop = [ir.Instr(ir.SPECULATE)]
+  loop.extend(body)
+  loop.append(ir.Instr(ir.COMMIT))
+  loop.extend(sd_effects)
+  loop.append(ir.Instr(ir.JMP, labels=(header,)))
+  return loop
+
+def stitch_loop_trace(program, header, exit_label, trace, sd_effects, branch_code=()):
+  """
+  put the speculative loop trace right after the loop header label in main and
+  make it loop: after commit it jumps back to the header and speculates on the
+  next iteration. A failed guard rolls back to the state at the start of the
+  iteration and runs the original header, which now lives under exit_label,
+  so leaving the loop or taking a cold path goes through the original code.
+  branch_code (the other regions of a trace tree) goes before exit_label.
+  """
+  main_func = program.function("main")
+  loop = loop_region(trace, sd_effects, header)
+  loop.extend(branch_code)
+  loop.append(ir.Instr.label(exit_label))
+  pos = cfg.build(main_func).label_position(header) + 1
+  main_func.instrs[pos:pos] = loop
+  return program
+
+def stitch_loop_tree(program, header, exit_label, paths, parents, var_types, side_exits):
+  """
+  guard every path of a trace tree and stitch it in after the loop header.
+  The first path is placed as by stitch_loop_trace, each other one gets its
+  own speculate/commit region under a fresh label that the guard on the
+  branch where it leaves its parent fails to, so an iteration that takes it
+  rolls back and runs it speculatively instead of the original code.
+  Unbiased branches per side_exits stay branches, their side exits go after
+  the regions.
+  """
+  main_func = program.function("main")
+  labels = [None] + [fresh_label(main_func, f"{header}.branch.{i}") for i in range(1, len(paths))]
+  exits = {}
+  for path in paths:
+    exits.update(side_exits.unbiased(path))
+  # a branch the tree continues at goes to its subtree, not out of the trace
+  for (i, (parent, branch)) in enumerate(parents):
+    exits[id(branch)] = labels[i + 1]
+  regions = []
+  for path in paths:
+    side_effects = []
+    guarded = guard_trace(path, program.names, var_types, side_effects, exit_label, exits, side_exits)
+    regions.append((list(stats.timed("guard_trace", guarded)), side_effects))
+  with stats.stage("stitch_trace"):
+    branch_code = []
+    for (label, (body, side_effects)) in zip(labels[1:], regions[1:]):
+      branch_code.append(ir.Instr.label(label))
+      branch_code.extend(loop_region(body, side_effects, header))
+    branch_code.extend(side_exits.stubs)
+    body, side_effects = regions[0]
+    return stitch_loop_trace(program, header, exit_label, body, side_effects, branch_code)
+
+def stitch_trace(program, trace, sd_effects, stubs=()):
+  """
+  put the speculative trace at the top of main, after commit run the side
+  effects and then the jump or ret the trace ends with, followed by the stubs
+  of its side exits. main is left alone if the trace doesn't say where to go
+  after it.
+  """
+  main_func = program.function("main")
     
   if not main_func:
-    print("error no main found")
+    print("error no main found", file=sys.stderr)
     sys.exit(1)
     
+  # side effects are only filled in once the trace has been consumed
+  body = list(trace)
+  if not body or body[-1].op not in ir.TERMINATORS:
+    return program
+  exit_instr = body.pop()
+
   new_instrs = []
   
-  new_instrs.append({"op": "speculate"})
-  has_return = trace and trace[-1].get('op') == 'ret'
-  if has_return:
-    new_instrs.extend(trace[:-1])
-    new_instrs.append({"op": "commit"})
-    new_instrs.extend(sd_effects)
-    new_instrs.append(trace[-1])
-  else:
-    new_instrs.extend(trace)
-    new_instrs.append({"op": "commit"})
+  new_instrs.append(ir.Instr(ir.SPECULATE))
+  new_instrs.extend(body)
+  new_instrs.append(ir.Instr(ir.COMMIT))
+  new_instrs.extend(sd_effects)
+  new_instrs.append(exit_instr)
+  new_instrs.extend(stubs)
   
-  new_instrs.append({'label': 'original_code'})
+  new_instrs.append(ir.Instr.label('original_code'))
 
-  new_instrs.extend(main_func['instrs'])
+  new_instrs.extend(main_func.instrs)
   
-  main_func['instrs'] = new_instrs
+  main_func.instrs = new_instrs
   
   return program
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  main()
@@ -0,0 +1,260 @@
+"""
+Program Interchange
+Cynthia Shao and Jonathan Brown
+
+How the scripts pass programs to each other over pipes. Every script reads
+its input with read_program, which takes Bril json or the binary form below
+and tells them apart by the first bytes, and writes with write_program in one
+of three formats:
+
+  json      minified json, the default, still readable by brili and bril2txt
+  pretty    indented json, with --pretty
+  binary    with --binary, only our own scripts read it
+
+The binary form is MAGIC, the payload length as 8 little-endian bytes, then
+a marshal payload of the opcode name table, the variable name table and per
+function a tuple of (name, args, type, instrs), every instruction a tuple of
+ir.Instr's fields with ops and variables as indices into the tables. It
+decodes straight into an ir.Program without building json dicts, e.g.
+
+  python trace.py -std --binary < prog.bril | python lvn.py --binary | python dce.py
+
+For modules too big to hold, read_functions and write_functions stream a json
+program one function at a time, so lvn.py and dce.py with --stream only ever
+hold the function they are optimizing:
+
+  python lvn.py --stream < big.json | python dce.py --stream
+"""
+
+import codecs
+import json
+import marshal
+import re
+import struct
+import sys
+import textwrap
+
+import ir
+import parallel
+
+# json can't start with a NUL, so this never collides with a json program
+MAGIC = b"\x00BRB1"
+LENGTH = struct.Struct("<Q")
+MARSHAL_VERSION = 4
+
+def output_format(argv):
+    """the format flag in a script's argv, json when there is none"""
+    if "--binary" in argv:
+        return "binary"
+    if "--pretty" in argv:
+        return "pretty"
+    return "json"
+
+def add_format_options(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--binary', dest='format', action='store_const', const='binary', default='json',
+                       help='Write the program in the compact binary form for the next script to read')
+    group.add_argument('--pretty', dest='format', action='store_const', const='pretty',
+                       help='Write indented json instead of minified json')
+
+# ==== BINARY ====
+
+def encode(program):
+    functions = [
+        (func.name, tuple(func.args), func.type,
+         [(instr.op, instr.dest, instr.type, instr.args, instr.funcs, instr.labels, instr.value)
+          for instr in func.instrs])
+        for func in program.functions
+    ]
+    payload = marshal.dumps((ir.OP_NAMES, program.names.names, functions), MARSHAL_VERSION)
+    return MAGIC + LENGTH.pack(len(payload)) + payload
+
+def decode(data):
+    start = len(MAGIC) + LENGTH.size
+    (length,) = LENGTH.unpack_from(data, len(MAGIC))
+    if len(data) < start + length:
+        raise ValueError(f"truncated binary program: expected {length} bytes, got {len(data) - start}")
+    op_names, var_names, functions = marshal.loads(data[start:start + length])
+    # opcodes of the writer -> ours, registering any we haven't seen
+    ops = [ir.opcode(name) for name in op_names]
+    names = ir.Names()
+    names.names = list(var_names)
+    names.ids = {name: i for (i, name) in enumerate(var_names)}
+    Instr = ir.Instr
+    program = []
+    for (fname, args, ftype, instrs) in functions:
+        body = [Instr(ops[op], dest, typ, args_, funcs, labels, value)
+                for (op, dest, typ, args_, funcs, labels, value) in instrs]
+        program.append(ir.Function(fname, list(args), ftype, body))
+    return ir.Program(program, names)
+
+# ==== READING AND WRITING ====
+
+def read_program(stream=None):
+    """read a json or binary program from stream (stdin by default) as an ir.Program"""
+    if stream is None:
+        stream = sys.stdin.buffer
+    data = stream.read()
+    if data.startswith(MAGIC):
+        return decode(data)
+    return ir.from_json(json.loads(data))
+
+def write_json(bril, fmt, stream=None):
+    """write a json program (dict) as json or pretty json"""
+    if stream is None:
+        stream = sys.stdout
+    # one dumps and write, json.dump writes chunk by chunk
+    if fmt == "pretty":
+        stream.write(json.dumps(bril, indent=4))
+    else:
+        stream.write(json.dumps(bril, separators=(",", ":")))
+
+def write_program(program, fmt, stream=None):
+    """write an ir.Program to stream (stdout by default) in fmt"""
+    if fmt == "binary":
+        if stream is None:
+            sys.stdout.flush()
+            stream = sys.stdout.buffer
+        stream.write(encode(program))
+        stream.flush()
+    else:
+        write_json(ir.to_json(program), fmt, stream)
+
+# ==== STREAMING ====
+
+# bytes read at a time when streaming
+CHUNK = 1 << 20
+WHITESPACE = re.compile(r"\s*")
+DECODER = json.JSONDecoder()
+
+class JsonReader:
+    """
+    Reads json values off a byte stream a piece at a time, keeping only the
+    text of the value being decoded buffered
+    """
+
+    def __init__(self, stream, head=b""):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = self.decoder.decode(head)
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, want):
+        """drop the text already consumed and buffer at least want more characters, or up to eof"""
+        if self.pos:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        while len(self.text) < want and not self.eof:
+            data = self.stream.read(max(CHUNK, want - len(self.text)))
+            if not data:
+                self.eof = True
+                self.text += self.decoder.decode(b"", final=True)
+            else:
+                self.text += self.decoder.decode(data)
+
+    def peek(self):
+        """the next character that isn't whitespace, "" at the end"""
+        while True:
+            self.pos = WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text) or self.eof:
+                return self.text[self.pos:self.pos + 1]
+            self.fill(CHUNK)
+
+    def expect(self, chars):
+        c = self.peek()
+        if c == "" or c not in chars:
+            raise ValueError(f"expected one of {chars!r} in json program, got {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        want = CHUNK
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.text, self.pos)
+                # a number at the end of the buffer may go on in the next chunk
+                if end < len(self.text) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # decode again with twice the text, so a big value costs linear time overall
+            want = max(want, 2 * (len(self.text) - self.pos))
+            self.fill(want)
+
+def read_functions(stream=None):
+    """
+    yield the functions of a program on stream (stdin by default) as json
+    dicts, reading only as far as the current one. A binary program can't be
+    read in pieces, it is decoded whole and its functions converted.
+    """
+    if stream is None:
+        stream = sys.stdin.buffer
+    head = stream.read(len(MAGIC))
+    if head == MAGIC:
+        program = decode(head + stream.read())
+        for func in program.functions:
+            yield ir.function_to_json(func, program.names)
+        return
+    reader = JsonReader(stream, head)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value()
+        reader.expect(":")
+        if key != "functions":
+            reader.value()
+        else:
+            reader.expect("[")
+            if reader.peek() == "]":
+                reader.pos += 1
+            else:
+                while True:
+                    yield reader.value()
+                    if reader.expect(",]") == "]":
+                        break
+        if reader.expect(",}") == "}":
+            return
+
+def write_functions(functions, fmt, stream=None):
+    """write json function dicts as a json or pretty json program as they come"""
+    if fmt == "binary":
+        raise ValueError("a streamed program is written as json")
+    if stream is None:
+        stream = sys.stdout
+    if fmt == "pretty":
+        start, sep, end, empty = '{\n    "functions": [\n', ",\n", "\n    ]\n}", '{\n    "functions": []\n}'
+        dump = lambda func: textwrap.indent(json.dumps(func, indent=4), " " * 8)
+    else:
+        start, sep, end, empty = '{"functions":[', ",", "]}", '{"functions":[]}'
+        dump = lambda func: json.dumps(func, separators=(",", ":"))
+    first = True
+    for func in functions:
+        stream.write((start if first else sep) + dump(func))
+        first = False
+    stream.write(empty if first else end)
+
+def check_stream_argv(argv):
+    """exit if argv combines --stream with binary output or a whole-program flag"""
+    if "--binary" in argv:
+        raise SystemExit("--stream writes json, it can't be combined with --binary")
+    if "--incremental" in argv or parallel.jobs_arg(argv) is not None:
+        raise SystemExit("--stream optimizes one function at a time, without --incremental or -j/--jobs")
+
+def stream_program(optimize, fmt, instream=None, outstream=None):
+    """
+    run optimize (taking and changing an ir.Program in place) on a program one
+    function at a time, writing each out before the next is read
+    """
+    def optimized():
+        for func in read_functions(instream):
+            names = ir.Names()
+            program = ir.Program([ir.function_from_json(func, names)], names)
+            del func
+            optimize(program)
+            yield ir.function_to_json(program.functions[0], names)
+    write_functions(optimized(), fmt, outstream)